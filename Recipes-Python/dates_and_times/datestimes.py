@@ -9,6 +9,9 @@ Various functions for handling date and time.
 """
 
 
+import numbers
+
+
 def parse_w3c_timedur(duration_str):
     """
     Parse a time duration that is represented in the ISO 8601 format borrowed
@@ -89,6 +92,27 @@ def secs_to_str(total_secs):
 #
 
 
+_DT_FLOOR_MAGNITUDES = ('year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond')
+
+_DT_FLOOR_REPLACEMENTS = {
+    'year':        dict(month=1, day=1, hour=0, minute=0, second=0, microsecond=0),
+    'month':       dict(day=1, hour=0, minute=0, second=0, microsecond=0),
+    'day':         dict(hour=0, minute=0, second=0, microsecond=0),
+    'hour':        dict(minute=0, second=0, microsecond=0),
+    'minute':      dict(second=0, microsecond=0),
+    'second':      dict(microsecond=0),
+    'microsecond': dict(),
+}
+    # `datetime.replace` arguments that floor a datetime to each magnitude
+
+_DT64_UNITS = {'year': 'Y', 'month': 'M', 'day': 'D', 'hour': 'h',
+               'minute': 'm', 'second': 's', 'microsecond': 'us'}
+
+_EPOCH_UNIT_SECS = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}
+
+_MAGNITUDE_SECS = {'day': 86400, 'hour': 3600, 'minute': 60, 'second': 1}
+
+
 def dt_floor(dt, magnitude='day'):
     """
     Floor a datetime according to a given magntiude.
@@ -104,19 +128,67 @@ def dt_floor(dt, magnitude='day'):
     :Return:
     The floor of `dt` with respect to magnitude `magnitude`.
     """
-    mags = ('year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond')
-    subs = ( None,   1,       1,     0,      0,        0,        0)
-
-    if magnitude not in mags:
-        raise ValueError("Unknown magnitude '%s'; choose from: %s" % (magnitude, ', '.join(mags)))
-
-    replace_from = mags.index(magnitude)
-    for indx in xrange(replace_from+1, len(mags)):
-        mag = mags[indx]
-        sub = subs[indx]
-        arg = {mag: sub}
-        dt = dt.replace(**arg)
-    return dt
+    try:
+        replacements = _DT_FLOOR_REPLACEMENTS[magnitude]
+    except KeyError:
+        raise ValueError("Unknown magnitude '%s'; choose from: %s" % (magnitude, ', '.join(_DT_FLOOR_MAGNITUDES)))
+    return dt.replace(**replacements)
+
+
+def dt_floor_many(values, magnitude='day', unit='s'):
+    """
+    Floor many times at once according to a given magnitude. A batch version
+    of `dt_floor`.
+
+    `values` may be:
+    * a numpy datetime64 array (or a pandas Series or DatetimeIndex of
+      naive datetimes). All magnitudes permitted by `dt_floor` are
+      supported. Returns a datetime64 array of the same unit.
+    * a numpy integer array (or a single int) of times since the Unix epoch,
+      in units of `unit` ('s', 'ms', 'us', or 'ns'). Only the fixed-duration
+      magnitudes ('day', 'hour', 'minute', 'second') are supported. Returns
+      floored epoch times in the same unit. Days are UTC days.
+    * any other sequence of datetimes. Returns a list of floored datetimes.
+
+    The array cases are vectorised; no Python-level work is done per value.
+    """
+    if magnitude not in _DT_FLOOR_REPLACEMENTS:
+        raise ValueError("Unknown magnitude '%s'; choose from: %s" % (magnitude, ', '.join(_DT_FLOOR_MAGNITUDES)))
+
+    if isinstance(values, numbers.Integral):
+        step = _epoch_floor_step(magnitude, unit)
+        return values - (values % step)
+
+    dtype = getattr(values, 'dtype', None)
+    if dtype is None:
+        return [dt_floor(dt, magnitude) for dt in values]
+
+    import numpy as np
+    if not isinstance(dtype, np.dtype):
+        # e.g., pandas timezone-aware datetimes
+        return [dt_floor(dt, magnitude) for dt in values]
+
+    if np.issubdtype(dtype, np.datetime64):
+        # casting to a coarser datetime64 unit floors (also before 1970).
+        # pandas datetime arrays can't be cast to coarser units directly
+        values = np.asarray(values)
+        return values.astype('datetime64[%s]' % _DT64_UNITS[magnitude]).astype(dtype)
+    elif np.issubdtype(dtype, np.integer):
+        step = _epoch_floor_step(magnitude, unit)
+        return values - (values % step)
+    else:
+        return [dt_floor(dt, magnitude) for dt in values]
+
+
+def _epoch_floor_step(magnitude, unit):
+    """
+    Duration of `magnitude`, in epoch units `unit`.
+    """
+    if magnitude not in _MAGNITUDE_SECS:
+        raise ValueError("Magnitude '%s' is not a fixed duration; choose from: %s" % (magnitude, ', '.join(sorted(_MAGNITUDE_SECS))))
+    if unit not in _EPOCH_UNIT_SECS:
+        raise ValueError("Unknown epoch unit '%s'; choose from: %s" % (unit, ', '.join(sorted(_EPOCH_UNIT_SECS))))
+    return _MAGNITUDE_SECS[magnitude] * _EPOCH_UNIT_SECS[unit]
 
 
 def generate_fixed_bucket_times(min_dt, max_dt, bucket_width):
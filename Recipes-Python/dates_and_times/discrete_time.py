@@ -7,16 +7,11 @@
 # Version: 1.0.1
 #          10 Feb 2015
 #
-# Future improvements:
-#
-# Define a "Discretiser" class. Discretiser(bucket_width, origin_time) would 
-# handle a discretisation of time from origin time `origin` with buckets of 
-# width `bucket_width`. This would also allow choices of bucket_width that
-# do not evenly divide a day.
-# The methods would be the same as those already provided in this module.
-# In addition, new methods could include `interval_as_discrete` which,
-# for a given walltime-to-walltime pair, would return the series of 
-# discrete bucket start times that the interval spans.
+# Updates:
+#   The "Discretiser" class handles a discretisation of time from an
+#   arbitrary origin time, with buckets of any width (not only widths that
+#   evenly divide a day). The module-level functions are implemented on top
+#   of it.
 
 
 """
@@ -33,42 +28,33 @@ time or or walltime) in a discrete way.
 Discretising time can be trick with respect to time zones that observe DST.
 A recommended approach is, for any datetimes to be passed to this module,
 to first localise to UTC (or any other time zone that does not adjust for DST).
+To bucket UTC times by local days or hours, see `local_bucket_times`.
 """
 
 
+from __future__ import print_function
+
+import array
+import bisect
+import collections
 from collections import OrderedDict
 from datetime import datetime, timedelta
-import fractions
-
-
-def dt_floor(dt, magnitude='day'):
-    """
-    Floor a datetime according to a given magntiude.
+import heapq
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-    For example,
-        dt_floor(datetime(2014, 2, 28, 13, 30), magnitude='day'),
-    will return the datetime floored to the lowest day:
-        datetime(2014, 2, 28, 0, 0).
+from datestimes import dt_floor, dt_floor_many
 
-    Permitted magnitudes are:
-        'year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond'
 
-    :Return:
-    The floor of `dt` with respect to magnitude `magnitude`.
+def _td_micros(td):
     """
-    mags = ('year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond')
-    subs = ( None,   1,       1,     0,      0,        0,        0)
-
-    if magnitude not in mags:
-        raise ValueError("Unknown magnitude '%s'; choose from: %s" % (magnitude, ', '.join(mags)))
-
-    replace_from = mags.index(magnitude)
-    for indx in xrange(replace_from+1, len(mags)):
-        mag = mags[indx]
-        sub = subs[indx]
-        arg = {mag: sub}
-        dt = dt.replace(**arg)
-    return dt
+    Total number of microseconds in timedelta `td`, as an exact integer.
+    (Unlike `td.total_seconds()`, this is not subject to float rounding.)
+    """
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
 
 
 def __valid_day_partition(bucket_width):
@@ -78,12 +64,18 @@ def __valid_day_partition(bucket_width):
     if bucket_width > timedelta(days=1):
         return False
 
-    if (timedelta(days=1).total_seconds() % bucket_width.total_seconds()) != 0:
+    if (_td_micros(timedelta(days=1)) % _td_micros(bucket_width)) != 0:
         return False
 
     return True
 
 
+_EPOCH = datetime(1970, 1, 1)
+
+_day_discretisers = {}
+    # cache of validated bucket widths -> Discretiser, for `to_bucket_time`
+
+
 def to_bucket_time(dt, bucket_width):
     """
     'Fix' a continuous time value (datetime `dt`) to its nearest 'fixed' bucket
@@ -94,25 +86,28 @@ def to_bucket_time(dt, bucket_width):
     i.e.,
         f    <=    dt    <    f + bucket_width.
 
+    Buckets begin from 00:00 (wallclock time) on each day.
+
     :Params:
     `dt`:
         The datetime to be 'fixed'.
     `bucket_width`:
         The bucket width, represented by a timedelta.
     """
-    if not __valid_day_partition(bucket_width):
-        raise ValueError("'%s' does not evenly partition 24 hours" % bucket_width)
-
-    buck_secs = bucket_width.total_seconds()
-
-    dt_origin = dt_floor(dt, 'day')
-    delt_secs = (dt - dt_origin).total_seconds()  #offset into the day
-
-    buck_mult = int(delt_secs // buck_secs)
-
-    fixed_dt = dt_origin + (bucket_width * buck_mult)
-    assert fixed_dt <= dt < (fixed_dt + bucket_width)
-    return fixed_dt
+    try:
+        discretiser = _day_discretisers[bucket_width]
+    except KeyError:
+        if not __valid_day_partition(bucket_width):
+            raise ValueError("'%s' does not evenly partition 24 hours" % bucket_width)
+        discretiser = Discretiser(bucket_width, _EPOCH)
+        _day_discretisers[bucket_width] = discretiser
+
+    # since the bucket width evenly partitions a day, bucketing relative to
+    # any midnight is the same as bucketing relative to midnight on `dt`
+    if dt.tzinfo is not None:
+        # bucket according to wallclock time
+        return discretiser.to_bucket(dt.replace(tzinfo=None)).replace(tzinfo=dt.tzinfo)
+    return discretiser.to_bucket(dt)
 
 
 def generate_bucket_times(min_dt, max_dt, bucket_width):
@@ -159,8 +154,474 @@ def generate_bucket_times(min_dt, max_dt, bucket_width):
         dt += bucket_width
 
 
+class Discretiser(object):
+    """
+    A discretisation of time into buckets of width `bucket_width`, starting
+    from origin time `origin_time`. The buckets are the half-open intervals
+        [origin_time + k * bucket_width,  origin_time + (k+1) * bucket_width)
+    for all integers k (including negative k). Here, k is the bucket's index.
+
+    Unlike the module-level functions, `bucket_width` need not evenly
+    partition a day, and buckets need not start at midnight.
+
+    Bucket indices and times are found by integer arithmetic relative to the
+    origin, so no per-call validation or flooring is needed.
+
+    The origin should be timezone-aware if (and only if) the datetimes to be
+    discretised are timezone-aware. By default, the origin is
+    1970-01-01 00:00 (naive).
+    """
+
+    def __init__(self, bucket_width, origin_time=None):
+        if bucket_width <= timedelta():
+            raise ValueError("Bucket width must be positive")
+        if origin_time is None:
+            origin_time = _EPOCH
+
+        self.bucket_width = bucket_width
+        self.origin_time = origin_time
+        self._width_micros = _td_micros(bucket_width)
+
+    def bucket_index(self, dt):
+        """
+        Index of the bucket containing datetime `dt`.
+        """
+        return _td_micros(dt - self.origin_time) // self._width_micros
+
+    def bucket_time(self, index):
+        """
+        Start time of the bucket with index `index`.
+        """
+        return self.origin_time + self.bucket_width * index
+
+    def to_bucket(self, dt):
+        """
+        Start time of the bucket containing datetime `dt`. As for
+        `to_bucket_time`.
+        """
+        return self.bucket_time(self.bucket_index(dt))
+
+    def generate_bucket_times(self, min_dt, max_dt):
+        """
+        Generate bucket times, from the bucket containing `min_dt` to the
+        bucket containing `max_dt` (inclusive). As for `generate_bucket_times`.
+        """
+        dt = self.to_bucket(min_dt)
+        while dt <= max_dt:
+            yield dt
+            dt += self.bucket_width
+
+    def _period_bucket_times(self, min_dt, max_dt):
+        """
+        List of the bucket times of the period from `min_dt` (inclusive) to
+        `max_dt` (exclusive). Raises ValueError if the period has no buckets;
+        i.e., if `min_dt` == `max_dt` and falls on a bucket boundary.
+        """
+        buck_times = [dt for dt in self.generate_bucket_times(min_dt, max_dt) if dt != max_dt]
+        if not buck_times:
+            raise ValueError("No buckets between min bound and max bound (max bound is exclusive)")
+        return buck_times
+
+    def interval_indices(self, dt1, dt2):
+        """
+        Indices of the first and last (inclusive) buckets touched by the
+        half-open interval [dt1, dt2). A zero-duration interval touches the
+        single bucket containing it.
+        """
+        if not (dt1 <= dt2):
+            raise ValueError("Unexpected negative-duration interval: [%s, %s)" % (dt1, dt2))
+
+        indx1 = self.bucket_index(dt1)
+        offset2 = _td_micros(dt2 - self.origin_time)
+        indx2 = offset2 // self._width_micros
+
+        if (offset2 % self._width_micros) == 0:
+            # the interval's end time falls exactly on a bucket start time.
+            # recall that intervals are half-open; thus bucket `indx2` is not
+            # touched, unless the interval is zero-duration
+            if dt1 != dt2:
+                indx2 -= 1  # shift left by one bucket
+
+        assert indx1 <= indx2
+        return indx1, indx2
+
+    def interval_as_discrete(self, dt1, dt2):
+        """
+        List of the start times of the buckets touched by the half-open
+        interval [dt1, dt2).
+        """
+        indx1, indx2 = self.interval_indices(dt1, dt2)
+        return [self.bucket_time(indx) for indx in range(indx1, indx2+1)]
+
+    def discretise(self, rows, min_dt, max_dt,
+                   func_start=None, func_end=None, cut_oob=False):
+        """
+        Discretise a collection of rows representing continuous-time
+        intervals. As for `discretise`, except that buckets are those of this
+        discretisation.
+
+        :Returns:
+        OrderedDict of datetime -> list mappings.
+        """
+        if not (min_dt <= max_dt):
+            raise ValueError("max bound should not precede minimum bound")
+
+        if func_start is None:
+            func_start = lambda row: row[0]
+        if func_end is None:
+            func_end = lambda row: row[1]
+
+        buck_times = self._period_bucket_times(min_dt, max_dt)
+        buckets = OrderedDict((buck_time, []) for buck_time in buck_times)
+        buck_lists = list(buckets.values())
+
+        # bucket indices of rows are relative to the origin; offset them to
+        # indices into `buck_lists`
+        left_indx = self.bucket_index(buck_times[0])  # lowest allocatable bucket
+        right_indx = left_indx + len(buck_lists) - 1  # highest allocatable bucket
+
+        for row in rows:
+            #
+            # find the range of buckets the row's interval touches
+            # the resulting range (i.e., indx1 to indx2) is an inclusive (at
+            # both ends) range of bucket indices that this row should be
+            # allocated to
+            dt1_orig = func_start(row)
+            dt2_orig = func_end(row)
+            indx1, indx2 = self.interval_indices(dt1_orig, dt2_orig)
+
+            #
+            # slice out-of-bounds intervals
+            if cut_oob:
+                indx1 = max(indx1, left_indx)
+                indx2 = min(indx2, right_indx)
+                if indx2 < indx1:
+                    # this row's interval is wholly outside the bounds
+                    continue
+            elif indx1 < left_indx or indx2 > right_indx:
+                raise ValueError("Interval [%s, %s) falls outside the bounds" % (dt1_orig, dt2_orig))
+
+            for lst in buck_lists[indx1-left_indx:indx2-left_indx+1]:
+                lst.append(row)
+
+        return buckets
+
+    def discretise_compact(self, rows, min_dt, max_dt,
+                           func_start=None, func_end=None, cut_oob=False):
+        """
+        As for `discretise`, but returns a `CompactBuckets`, which holds the
+        first and last bucket of each row, rather than a list of rows per
+        bucket.
+        """
+        if not (min_dt <= max_dt):
+            raise ValueError("max bound should not precede minimum bound")
+
+        if func_start is None:
+            func_start = lambda row: row[0]
+        if func_end is None:
+            func_end = lambda row: row[1]
+
+        buck_times = self._period_bucket_times(min_dt, max_dt)
+        num_bucks = len(buck_times)
+        left_indx = self.bucket_index(buck_times[0])
+
+        #
+        # find the (inclusive) range of buckets for each row, relative to
+        # the first bucket
+        rows = list(rows)
+        first_bucks = array.array('i')
+        last_bucks = array.array('i')
+        for row in rows:
+            dt1_orig = func_start(row)
+            dt2_orig = func_end(row)
+            indx1, indx2 = self.interval_indices(dt1_orig, dt2_orig)
+            indx1 -= left_indx
+            indx2 -= left_indx
+
+            if cut_oob:
+                indx1 = max(indx1, 0)
+                indx2 = min(indx2, num_bucks - 1)
+                if indx2 < indx1:
+                    # this row's interval is wholly outside the bounds, so
+                    # give it an empty range of buckets
+                    indx1, indx2 = 0, -1
+            elif indx1 < 0 or indx2 > num_bucks - 1:
+                raise ValueError("Interval [%s, %s) falls outside the bounds" % (dt1_orig, dt2_orig))
+
+            first_bucks.append(indx1)
+            last_bucks.append(indx2)
+
+        return CompactBuckets(rows, buck_times[0], self.bucket_width, num_bucks,
+                              first_bucks, last_bucks)
+
+
+class CompactBuckets(object):
+    """
+    A compact representation of the allocation of rows to buckets, as
+    returned by `discretise(..., compact=True)`.
+
+    Since a row's interval always touches a contiguous run of buckets, the
+    allocation is held per row rather than per bucket: row `i` (of `rows`)
+    is in buckets
+        first_buckets[i], ..., last_buckets[i]
+    (inclusive; a row in no bucket has an empty range, such as 0 to -1).
+    `first_buckets` and `last_buckets` are `array.array`s of 4-byte
+    integers, so the allocation takes 8 bytes per row, however many buckets
+    each row touches.
+
+    Lists of rows are built on demand. Iterating over a `CompactBuckets`
+    yields bucket times, and `iteritems()` yields (bucket time, list of rows)
+    pairs, as for the OrderedDict returned by `discretise`. Within each
+    bucket, rows are in the order of `rows`.
+
+    `iteritems()` sweeps through the buckets in order, so is the efficient
+    way to visit every bucket; looking up a single bucket scans all rows.
+    """
+
+    def __init__(self, rows, first_bucket_time, bucket_width, num_buckets,
+                 first_buckets, last_buckets):
+        if not (len(rows) == len(first_buckets) == len(last_buckets)):
+            raise ValueError("`rows`, `first_buckets` and `last_buckets` must be the same length")
+        self.rows = rows
+        self.first_bucket_time = first_bucket_time
+        self.bucket_width = bucket_width
+        self.num_buckets = num_buckets
+        self.first_buckets = first_buckets
+        self.last_buckets = last_buckets
+        self._discretiser = Discretiser(bucket_width, first_bucket_time)
+
+    def __len__(self):
+        return self.num_buckets
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, bucket_time):
+        try:
+            self.index_of(bucket_time)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, bucket_time):
+        return self.bucket_rows(self.index_of(bucket_time))
+
+    def keys(self):
+        """
+        List of bucket times.
+        """
+        return [self._discretiser.bucket_time(indx) for indx in xrange(len(self))]
+
+    def index_of(self, bucket_time):
+        """
+        Index of the bucket with time `bucket_time`. Raises KeyError if there
+        is no such bucket.
+        """
+        indx = self._discretiser.bucket_index(bucket_time)
+        if not (0 <= indx < len(self)) or (self._discretiser.bucket_time(indx) != bucket_time):
+            raise KeyError(bucket_time)
+        return indx
+
+    def row_indices(self, index):
+        """
+        Indices (into `rows`) of the rows in the bucket with index `index`.
+        """
+        first_bucks = self.first_buckets
+        last_bucks = self.last_buckets
+        return [row_indx for row_indx in xrange(len(first_bucks))
+                if first_bucks[row_indx] <= index <= last_bucks[row_indx]]
+
+    def bucket_rows(self, index):
+        """
+        List of rows in the bucket with index `index`.
+        """
+        rows = self.rows
+        return [rows[i] for i in self.row_indices(index)]
+
+    def iteritems(self):
+        """
+        Yields (bucket time, list of rows) pairs, in order.
+        """
+        rows = self.rows
+        first_bucks = self.first_buckets
+        last_bucks = self.last_buckets
+
+        # rows enter the sweep in order of their first bucket, and leave it
+        # after their last bucket. `active` is kept in row order
+        entering = sorted((row_indx for row_indx in xrange(len(rows))
+                           if first_bucks[row_indx] <= last_bucks[row_indx]),
+                          key=first_bucks.__getitem__)
+        pos = 0
+        active = []
+        for indx in xrange(len(self)):
+            active = [row_indx for row_indx in active if last_bucks[row_indx] >= indx]
+            while pos < len(entering) and first_bucks[entering[pos]] == indx:
+                bisect.insort(active, entering[pos])
+                pos += 1
+            yield self._discretiser.bucket_time(indx), [rows[i] for i in active]
+
+    items = iteritems
+
+    def to_dict(self):
+        """
+        Convert to an OrderedDict of datetime -> list mappings, as returned
+        by `discretise`.
+        """
+        return OrderedDict(self.iteritems())
+
+
+class IncrementalDiscretiser(object):
+    """
+    A discretisation that is built incrementally, as new rows arrive, rather
+    than over a complete collection of rows.
+
+    Buckets begin at the bucket containing `min_dt`, and the range of
+    buckets grows as rows with later times are added (via `extend`), so
+    there is no fixed `max_dt`. Rows are allocated to every bucket their
+    half-open interval touches, as in `discretise`.
+
+    The state can be saved to a file (`save`) and later restored (`load`),
+    so that a growing feed of rows can be discretised by only processing the
+    new rows at each refresh. Saving requires the rows to be picklable.
+
+    Example:
+        disc = IncrementalDiscretiser(timedelta(minutes=5), datetime(2015, 1, 1))
+        disc.extend(rows)
+        disc.save('buckets.pkl')
+        ...
+        disc = IncrementalDiscretiser.load('buckets.pkl')
+        disc.extend(new_rows)
+        buckets = disc.buckets()
+    """
+
+    def __init__(self, bucket_width, min_dt, func_start=None, func_end=None,
+                 cut_oob=False, origin_time=None):
+        """
+        :Params:
+        bucket_width, min_dt, func_start, func_end:
+            As for `discretise`.
+
+        cut_oob:
+            If True, the parts of intervals preceding `min_dt` are cut, and
+            rows wholly preceding `min_dt` are discarded. If False, such rows
+            result in an error.
+
+        origin_time:
+            Origin of the buckets, as for `Discretiser`. By default, buckets
+            begin at midnight (in which case `bucket_width` should evenly
+            partition a day).
+        """
+        if origin_time is None:
+            origin_time = to_bucket_time(min_dt, bucket_width)
+        self._discretiser = Discretiser(bucket_width, origin_time)
+        self.min_dt = min_dt
+        self.cut_oob = cut_oob
+        self._set_funcs(func_start, func_end)
+
+        self._first_indx = self._discretiser.bucket_index(min_dt)
+        self._lists = []  # list of rows for each bucket, from the first
+
+    def _set_funcs(self, func_start, func_end):
+        if func_start is None:
+            func_start = lambda row: row[0]
+        if func_end is None:
+            func_end = lambda row: row[1]
+        self._func_start = func_start
+        self._func_end = func_end
+
+    @property
+    def bucket_width(self):
+        return self._discretiser.bucket_width
+
+    @property
+    def max_dt(self):
+        """
+        End of the final bucket (or None, if there are no buckets yet).
+        """
+        if not self._lists:
+            return None
+        return self._discretiser.bucket_time(self._first_indx + len(self._lists))
+
+    def __len__(self):
+        return len(self._lists)
+
+    def extend(self, rows):
+        """
+        Allocate rows in `rows` to buckets, growing the range of buckets as
+        needed.
+        """
+        func_start = self._func_start
+        func_end = self._func_end
+        lists = self._lists
+
+        for row in rows:
+            dt1_orig = func_start(row)
+            dt2_orig = func_end(row)
+            indx1, indx2 = self._discretiser.interval_indices(dt1_orig, dt2_orig)
+            indx1 -= self._first_indx
+            indx2 -= self._first_indx
+
+            if indx1 < 0:
+                if not self.cut_oob:
+                    raise ValueError("Interval [%s, %s) precedes the minimum bound" % (dt1_orig, dt2_orig))
+                indx1 = 0
+                if indx2 < indx1:
+                    # this row's interval wholly precedes the bounds
+                    continue
+
+            while len(lists) <= indx2:
+                lists.append([])
+
+            for indx in range(indx1, indx2+1):
+                lists[indx].append(row)
+
+    def buckets(self):
+        """
+        The current buckets, as an OrderedDict of datetime -> list mappings
+        (as returned by `discretise`). The lists are not copied, and so
+        should not be modified.
+        """
+        bucket_time = self._discretiser.bucket_time
+        return OrderedDict((bucket_time(self._first_indx + indx), lst)
+                           for indx, lst in enumerate(self._lists))
+
+    def save(self, fpath):
+        """
+        Save the state (bucket settings and rows) to file `fpath`. The file
+        is replaced atomically, so an interrupted save does not lose the
+        previous snapshot.
+        """
+        state = {
+            'bucket_width': self._discretiser.bucket_width,
+            'origin_time': self._discretiser.origin_time,
+            'min_dt': self.min_dt,
+            'cut_oob': self.cut_oob,
+            'lists': self._lists,
+        }
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath, func_start=None, func_end=None):
+        """
+        Restore an `IncrementalDiscretiser` saved to file `fpath`. Since
+        functions are not saved, `func_start` and `func_end` should be given
+        again (if not the defaults).
+        """
+        with open(fpath, 'rb') as f:
+            state = pickle.load(f)
+
+        disc = cls(state['bucket_width'], state['min_dt'],
+                   func_start=func_start, func_end=func_end,
+                   cut_oob=state['cut_oob'], origin_time=state['origin_time'])
+        disc._lists = state['lists']
+        return disc
+
+
 def discretise(rows, min_dt, max_dt, bucket_width,
-               func_start=None, func_end=None, cut_oob=False):
+               func_start=None, func_end=None, cut_oob=False, compact=False):
     """
     Discretise a collection of rows representing continuous-time intervals.
 
@@ -208,7 +669,9 @@ def discretise(rows, min_dt, max_dt, bucket_width,
         interval, as well as possibly other attributes.
 
     min_dt, max_dt:
-        Bounds of the time period being discretised. datetime objects.
+        Bounds of the time period being discretised. datetime objects. The
+        period must contain at least one bucket; i.e., if `min_dt` equals
+        `max_dt`, it must not fall on a bucket boundary.
 
     bucket_width:
         Width of the discrete time buckets.
@@ -228,71 +691,353 @@ def discretise(rows, min_dt, max_dt, bucket_width,
         the bounds.
         If False, rows falling outside the bounds will result in an error.
 
+    compact:
+        If True, return a `CompactBuckets` rather than an OrderedDict. This
+        holds the first and last bucket of each row in compact arrays, and
+        builds lists of rows lazily. It uses much less memory when rows span
+        many buckets.
+
     :Returns:
-    OrderedDict of datetime -> list mappings.
+    OrderedDict of datetime -> list mappings (or a `CompactBuckets`, if
+    `compact` is True).
+    """
+    discretiser = Discretiser(bucket_width, to_bucket_time(min_dt, bucket_width))
+    if compact:
+        discretise_func = discretiser.discretise_compact
+    else:
+        discretise_func = discretiser.discretise
+    return discretise_func(rows, min_dt, max_dt,
+                           func_start=func_start, func_end=func_end,
+                           cut_oob=cut_oob)
+
+
+def _discretise_shard(args):
+    """
+    Worker for `discretise_parallel`. Finds the (inclusive) range of buckets
+    for each of a shard's rows, from the rows' start and end times as
+    microseconds since the first bucket. Returns the first and last bucket
+    of each row, as for `CompactBuckets`.
     """
+    starts, ends, num_bucks, bucket_width, origin_time, cut_oob = args
+    width_micros = _td_micros(bucket_width)
+
+    first_bucks = array.array('i')
+    last_bucks = array.array('i')
+    for micros1, micros2 in zip(starts, ends):
+        if not (micros1 <= micros2):
+            raise ValueError("Unexpected negative-duration interval: [%s, %s)" % (
+                origin_time + timedelta(microseconds=micros1),
+                origin_time + timedelta(microseconds=micros2)))
+
+        indx1 = micros1 // width_micros
+        indx2 = micros2 // width_micros
+        if (micros2 % width_micros) == 0 and micros1 != micros2:
+            # half-open interval ending exactly on a bucket start time
+            indx2 -= 1
+
+        if cut_oob:
+            indx1 = max(indx1, 0)
+            indx2 = min(indx2, num_bucks - 1)
+            if indx2 < indx1:
+                indx1, indx2 = 0, -1
+        elif indx1 < 0 or indx2 > num_bucks - 1:
+            raise ValueError("Interval [%s, %s) falls outside the bounds" % (
+                origin_time + timedelta(microseconds=micros1),
+                origin_time + timedelta(microseconds=micros2)))
+
+        first_bucks.append(indx1)
+        last_bucks.append(indx2)
+    return first_bucks, last_bucks
+
+
+def discretise_parallel(rows, min_dt, max_dt, bucket_width,
+                        func_start=None, func_end=None, cut_oob=False,
+                        compact=False, processes=None, num_shards=None):
+    """
+    A parallel version of `discretise`, using a pool of worker processes.
+    Parameters and output are the same as `discretise`.
+
+    The rows are split into `num_shards` contiguous shards (by default, one
+    per process). The start and end times of each shard's rows are sent to
+    a worker as arrays of integers (microseconds since the first bucket),
+    and the worker returns the first and last bucket of each row. The
+    shards' results are joined end to end into a `CompactBuckets`. Rows
+    themselves (and `func_start` and `func_end`) are not sent to the
+    workers, so rows need not be picklable.
+
+    Finding each row's start and end time (with `func_start` and
+    `func_end`) is done in the calling process. So, unless `compact` is
+    True, is building the lists of rows in the output, which takes time in
+    proportion to the total number of row-bucket allocations. These steps
+    cap the speedup; when rows span many buckets, use `compact=True` and
+    iterate over the result instead.
+
+    :Params:
+    processes:
+        Number of worker processes. Defaults to the number of CPUs. If 1, no
+        worker processes are used.
+
+    num_shards:
+        Number of shards of rows. Defaults to `processes`.
+    """
+    import multiprocessing
+
     if not (min_dt <= max_dt):
         raise ValueError("max bound should not precede minimum bound")
-        # this also ensures that there is at least one bucket
 
     if func_start is None:
         func_start = lambda row: row[0]
     if func_end is None:
         func_end = lambda row: row[1]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if num_shards is None:
+        num_shards = processes
 
-    buckets = OrderedDict()
+    origin_time = to_bucket_time(min_dt, bucket_width)
+    discretiser = Discretiser(bucket_width, origin_time)
+    buck_times = discretiser._period_bucket_times(min_dt, max_dt)
+    num_bucks = len(buck_times)
 
-    for buck_time in generate_bucket_times(min_dt, max_dt, bucket_width):
-        if buck_time == max_dt:
-            # break early if the final bucket time happens to fall exactly
-            # on `max_dt`; recall that max_dt is exclusive
-            break
-        buckets[buck_time] = []
+    #
+    # start and end times of rows, as microseconds since the first bucket
+    # (array typecode 'l' is 64-bit on 64-bit Unix platforms)
+    rows = list(rows)
+    starts = array.array('l', [_td_micros(func_start(row) - origin_time) for row in rows])
+    ends = array.array('l', [_td_micros(func_end(row) - origin_time) for row in rows])
 
-    buck_times = buckets.keys()
-    buck_lists = buckets.values()
+    #
+    # find the buckets of each shard of rows
+    shard_size = max(-(-len(rows) // num_shards), 1)  # ceiling division
+    shard_args = [(starts[k:k+shard_size], ends[k:k+shard_size], num_bucks,
+                   bucket_width, origin_time, cut_oob)
+                  for k in xrange(0, len(rows), shard_size)]
+    del starts, ends
+    if processes == 1:
+        shard_results = [_discretise_shard(args) for args in shard_args]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            shard_results = pool.map(_discretise_shard, shard_args)
+        finally:
+            pool.close()
+            pool.join()
 
-    left_buckbound = buck_times[0]  # lowest allocatable bucket time
-    right_buckbound = buck_times[-1]  # highest allocatable bucket time
+    #
+    # join the shards, in row order
+    first_bucks = array.array('i')
+    last_bucks = array.array('i')
+    for shard_first, shard_last in shard_results:
+        first_bucks.extend(shard_first)
+        last_bucks.extend(shard_last)
+
+    buckets = CompactBuckets(rows, buck_times[0], bucket_width, num_bucks,
+                             first_bucks, last_bucks)
+    if compact:
+        return buckets
+    return buckets.to_dict()
+
+
+def discretise_arrays(starts, ends, min_dt, max_dt, bucket_width,
+                      cut_oob=False):
+    """
+    A vectorised (columnar) version of `discretise`, using NumPy.
+
+    Rather than a sequence of row objects and `func_start`/`func_end`
+    functions, this takes the interval start and end times as two
+    equal-length arrays: `starts[i]` and `ends[i]` are the start and end time
+    of the half-open interval represented by row `i`. Each may be a numpy
+    datetime64 array, a pandas Series of datetimes, or any sequence of
+    (naive) datetimes.
+
+    Rows are allocated to the same buckets as by `discretise`. However,
+    instead of lists of rows, the allocation is returned as arrays of
+    indices. Since a row always spans a contiguous run of buckets, row `i` is
+    allocated to buckets
+        bucket_start_idx[i], ..., bucket_end_idx[i]
+    (inclusive). The same allocation is also given in CSR form (as used by
+    scipy.sparse), mapping rows to buckets: the buckets of row `i` are
+        row_buckets[row_indptr[i]:row_indptr[i+1]].
 
-    for row in rows:
-        #
-        # extract interval start and end times, fixed to their discretised
-        # bucket times
-        # the resulting range (i.e., dt1 to dt2) is an inclusive (at both ends)
-        # range of bucket times that this row should be allocated to
-        dt1_orig = func_start(row)
-        dt2_orig = func_end(row)
-        if not (dt1_orig <= dt2_orig):
-            raise ValueError("Unexpected negative-duration interval: [%s, %s)" % (dt1_orig, dt2_orig))
-
-        dt1 = to_bucket_time(dt1_orig, bucket_width)
-        dt2 = to_bucket_time(dt2_orig, bucket_width)
-        
-        if dt2_orig == dt2:
-            # the row's end time falls exactly on a bucket start time.
-            # recall that row intervals are half-open; thus row should not#
-            # be added to bucket `dt2`, unless the interval is zero-duration
-            if dt1_orig != dt2_orig:
-                dt2 = dt2 - bucket_width  # shift left by one bucket
+    :Params:
+    starts, ends:
+        Array-likes of datetimes; the start and end times of the rows.
 
-        assert dt1 <= dt2
+    min_dt, max_dt, bucket_width, cut_oob:
+        As for `discretise`. If `cut_oob` is True, a row wholly outside the
+        bounds has a bucket_start_idx and bucket_end_idx of -1, and no
+        buckets in the CSR mapping.
 
-        #
-        # slice out-of-bounds intervals
-        if cut_oob:
-            dt1 = max([dt1, left_buckbound])
-            dt2 = min([dt2, right_buckbound])
-            if dt2 < dt1:
-                # this row's interval is wholly outside the bounds
-                continue
+    :Returns:
+    A tuple,
+        (bucket_times, bucket_start_idx, bucket_end_idx,
+         row_indptr, row_buckets)
+    where `bucket_times` is a datetime64[us] array of bucket times, and the
+    remainder are int64 arrays.
+    """
+    import numpy as np
 
-        indx1 = buck_times.index(dt1)
-        indx2 = buck_times.index(dt2)
-        for lst in buck_lists[indx1:indx2+1]:
-            lst.append(row)
+    if not (min_dt <= max_dt):
+        raise ValueError("max bound should not precede minimum bound")
+
+    bucket_times = np.array(list(generate_bucket_times(min_dt, max_dt, bucket_width)),
+                            dtype='datetime64[us]')
+    if bucket_times[-1] == np.datetime64(max_dt, 'us'):
+        # recall that max_dt is exclusive
+        bucket_times = bucket_times[:-1]
+    if len(bucket_times) == 0:
+        raise ValueError("No buckets between min bound and max bound (max bound is exclusive)")
+    num_bucks = len(bucket_times)
+
+    starts = np.asarray(starts, dtype='datetime64[us]').astype(np.int64)
+    ends = np.asarray(ends, dtype='datetime64[us]').astype(np.int64)
+    if starts.shape != ends.shape:
+        raise ValueError("`starts` and `ends` must be the same length")
+    if np.any(ends < starts):
+        i = int(np.argmax(ends < starts))
+        raise ValueError("Unexpected negative-duration interval at row %d" % i)
+
+    left_micros = bucket_times[0].astype(np.int64)
+    buck_micros = _td_micros(bucket_width)
+
+    indx1 = (starts - left_micros) // buck_micros
+    offset2 = ends - left_micros
+    indx2 = offset2 // buck_micros
+    # half-open intervals ending exactly on a bucket start time are not
+    # added to that bucket, unless zero-duration
+    indx2 -= ((offset2 % buck_micros) == 0) & (starts != ends)
+
+    if cut_oob:
+        np.maximum(indx1, 0, out=indx1)
+        np.minimum(indx2, num_bucks - 1, out=indx2)
+        outside = indx2 < indx1
+        indx1[outside] = -1
+        indx2[outside] = -1
+    else:
+        outside = (indx1 < 0) | (indx2 > num_bucks - 1)
+        if np.any(outside):
+            i = int(np.argmax(outside))
+            raise ValueError("Interval at row %d falls outside the bounds" % i)
+
+    counts = np.where(indx1 < 0, 0, indx2 - indx1 + 1)
+    row_indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=row_indptr[1:])
+
+    # each row's buckets are its start bucket plus 0, 1, 2, ...
+    row_buckets = np.repeat(indx1, counts)
+    row_buckets += np.arange(len(row_buckets)) - np.repeat(row_indptr[:-1], counts)
+
+    return bucket_times, indx1, indx2, row_indptr, row_buckets
+
+
+_tz_transition_tables = {}
+    # cache of time zone name -> (transition times, UTC offsets)
+
+
+def _tz_transition_table(tz_name):
+    """
+    UTC offset transition table for the pytz time zone named `tz_name`, as a
+    pair of int64 arrays
+        (transition times, UTC offsets).
+    Transition times are in microseconds since the Unix epoch (UTC). From
+    transition time `i` onwards (until the next), the UTC offset is
+    offsets[i] microseconds.
+    """
+    try:
+        return _tz_transition_tables[tz_name]
+    except KeyError:
+        pass
+
+    import numpy as np
+    import pytz
+
+    tz = pytz.timezone(tz_name)
+    utc_times = getattr(tz, '_utc_transition_times', None)
+    if utc_times:
+        trans = [_td_micros(dt - _EPOCH) for dt in utc_times]
+        offsets = [_td_micros(info[0]) for info in tz._transition_info]
+    else:
+        # a time zone with a fixed offset
+        trans = [_td_micros(datetime(1, 1, 1) - _EPOCH)]
+        offsets = [_td_micros(tz.utcoffset(datetime(2000, 1, 1)))]
+
+    table = (np.array(trans, dtype=np.int64), np.array(offsets, dtype=np.int64))
+    _tz_transition_tables[tz_name] = table
+    return table
+
+
+def local_bucket_times(timestamps, tz_name, magnitude='day', local=False):
+    """
+    Bucket UTC timestamps according to local (wallclock) time in time zone
+    `tz_name`, in bulk.
+
+    Each timestamp is allocated to the local day (or hour, or minute) that it
+    falls in. Buckets follow the local wallclock, so across DST shifts a
+    local day may last 23 or 25 hours; and when clocks go back, the repeated
+    local hour gives two distinct hourly buckets.
+
+    Rather than converting each timestamp via pytz, UTC offsets are looked
+    up (by binary search) in the time zone's table of offset transitions,
+    which is built once per time zone. Note that pytz's tables end in 2037;
+    later timestamps use the final offset.
+
+    :Params:
+    timestamps:
+        UTC times, as a numpy datetime64 array, a pandas Series of naive
+        (UTC) datetimes, or any sequence of naive (UTC) datetimes.
 
-    return buckets
+    tz_name:
+        Name of a time zone in the tz database (e.g., 'Europe/London').
+
+    magnitude:
+        'day', 'hour', or 'minute'.
+
+    local:
+        If False, buckets are identified by the UTC instant at which they
+        begin. If True, buckets are identified by their local wallclock start
+        time (e.g., local midnight), as naive datetime64s.
+
+    :Returns:
+    A datetime64[us] array, with the bucket of each timestamp.
+    """
+    import numpy as np
+
+    steps = {'day': 86400 * 10**6, 'hour': 3600 * 10**6, 'minute': 60 * 10**6}
+    if magnitude not in steps:
+        raise ValueError("Unknown magnitude '%s'; choose from: %s" % (magnitude, ', '.join(sorted(steps))))
+    step = steps[magnitude]
+
+    trans, offsets = _tz_transition_table(tz_name)
+    ts = np.asarray(timestamps, dtype='datetime64[us]').astype(np.int64)
+
+    # offset in effect at each timestamp, and that in effect before the
+    # most recent transition
+    indx = np.searchsorted(trans, ts, side='right') - 1
+    off = offsets[indx]
+    off_prev = offsets[np.maximum(indx - 1, 0)]
+
+    local_ts = ts + off
+    local_floor = local_ts - (local_ts % step)
+    if local:
+        return local_floor.astype('datetime64[us]')
+
+    # the bucket's local start time (e.g., midnight) may fall before the most
+    # recent transition, and so have the previous offset. the start is the
+    # latest candidate instant (at or before the timestamp) whose offset is
+    # consistent with the offset used to compute it
+    def offset_at(utc):
+        return offsets[np.searchsorted(trans, utc, side='right') - 1]
+
+    cand = local_floor - off
+    cand_prev = local_floor - off_prev
+    ok = (offset_at(cand) == off) & (cand <= ts)
+    ok_prev = (offset_at(cand_prev) == off_prev) & (cand_prev <= ts)
+
+    starts = np.where(ok, cand, cand_prev)
+    # neither: the local start time does not exist, as it was skipped when
+    # the clocks went forward; the bucket begins at the transition
+    starts = np.where(ok | ok_prev, starts, trans[indx])
+    return starts.astype('datetime64[us]')
 
 
 def discretise_nondisjoint(rows, min_dt, max_dt, bucket_width, increment,
@@ -316,12 +1061,25 @@ def discretise_nondisjoint(rows, min_dt, max_dt, bucket_width, increment,
 
 
 def discretise_nondisjoint_generator(rows, min_dt, max_dt, bucket_width, increment,
-               func_start=None, func_end=None, cut_oob=False):
+               func_start=None, func_end=None, cut_oob=False, origin_time=None):
     """
     Generator version of `discretise_nondisjoint`.
     `discretise_nondisjoint_generator` Yields (datetime, bucket) pairs. Whereas
     `discretise_nondisjoint` returns a concrete OrderedDict.
     The generator version allows more-efficient use of memory.
+
+    Window start times lie on a grid of step `increment` from `origin_time`
+    (default: the Unix epoch; i.e., midnight). The first window is the one
+    whose start time is the grid time containing `min_dt`, and windows then
+    start at every `increment` thereafter, up to the last window starting
+    before `max_dt`. Hence, if `increment` equals `bucket_width` (and
+    `origin_time` is a midnight), the windows are the same as the buckets of
+    `discretise`. A row belongs to each window that its half-open interval
+    touches, as in `discretise`. Within a window, rows are ordered by start
+    time.
+
+    Any `increment` up to `bucket_width` may be used; it need not divide
+    `bucket_width` or a day.
     """
     assert increment <= bucket_width
     assert increment > timedelta()
@@ -332,59 +1090,159 @@ def discretise_nondisjoint_generator(rows, min_dt, max_dt, bucket_width, increme
     if func_end is None:
         func_end = lambda row: row[1]
 
-    #
-    # currently only supports EVENTS (i.e., zero-duration intervals)
+    if not (min_dt <= max_dt):
+        raise ValueError("max bound should not precede minimum bound")
+
+    # approach:
+    # two pointers sweep over the rows, one in order of start time (rows
+    # entering the window) and one in order of end time (rows leaving the
+    # window). each row enters and leaves once, so the total work is
+    # proportional to the number of rows plus the number of windows, for
+    # any combination of `bucket_width` and `increment`
+
+    rows = list(rows)
+    starts = []
+    leaves = []
+        # a row has left window [t, t+bucket_width) if its 'leave time' is
+        # <= t. for a half-open interval this is its end time. a
+        # zero-duration interval (event) is still in the window if it
+        # occurs at t, so it leaves one microsecond later
     for row in rows:
-        assert (func_end(row) - func_start(row)).total_seconds() == 0
+        dt1 = func_start(row)
+        dt2 = func_end(row)
+        if not (dt1 <= dt2):
+            raise ValueError("Unexpected negative-duration interval: [%s, %s)" % (dt1, dt2))
+        starts.append(dt1)
+        leaves.append(dt2 if dt1 != dt2 else dt2 + timedelta(microseconds=1))
+
+    if origin_time is None:
+        origin_time = _EPOCH
+    win_first = Discretiser(increment, origin_time).to_bucket(min_dt)
+    num_wins = (_td_micros(max_dt - win_first) - 1) // _td_micros(increment) + 1
+    num_wins = max(num_wins, 0)
+    span_right = win_first + (increment * (num_wins - 1)) + bucket_width
+        # right edge of the final window
+
+    if not cut_oob:
+        for dt1, leave in zip(starts, leaves):
+            if (dt1 < win_first) or (leave > span_right):
+                raise ValueError("Interval starting %s falls outside the bounds" % dt1)
+
+    by_start = sorted(range(len(rows)), key=lambda i: starts[i])
+    by_leave = sorted(range(len(rows)), key=lambda i: leaves[i])
+    i_start = 0
+    i_leave = 0
+    window = OrderedDict()  # row index -> row, in order of entry
+
+    win_left = win_first
+    for _ in range(num_wins):
+        win_right = win_left + bucket_width
+
+        # add rows starting before the window's right edge
+        while (i_start < len(by_start)) and (starts[by_start[i_start]] < win_right):
+            indx = by_start[i_start]
+            window[indx] = rows[indx]
+            i_start += 1
+
+        # remove rows that have left by the window's left edge
+        while (i_leave < len(by_leave)) and (leaves[by_leave[i_leave]] <= win_left):
+            window.pop(by_leave[i_leave], None)
+            i_leave += 1
+
+        yield win_left, list(window.values())
+        win_left += increment
+
+
+class _SlidingWindow(object):
+    """
+    Sliding window over a sorted iterable of rows, used by
+    `discretise_generic` and `discretise_generic_aggregate`.
 
+    The window starts at [min_dt, min_dt + bucket_width) and is advanced by
+    `increment` on each call to `slide_window`. If given, `on_enter` and
+    `on_leave` are called with each row as it enters and leaves the window.
+
+    Rows may be intervals. A row is in the window if its half-open interval
+    [start, end) touches the window, as in `discretise`; a zero-duration
+    row (event) is in the window if it occurs within the window.
+    """
+    # buffer holds the contents of the current window, in order of start
+    # time, keyed by a sequence number. rows that have left the window have
+    # been discarded, and rows following the window have not yet been pulled
+    # from `rows` (except for the single lookahead row, `next_row`).
     #
-    # basic case
-    if increment == bucket_width:
-        bucksnaps = discretise(rows=rows, min_dt=min_dt, max_dt=max_dt,
-            bucket_width=bucket_width, func_start=func_start,
-            func_end=func_end, cut_oob=cut_oob)
-        for item in bucksnaps.iteritems():
-            yield item
-        ##return discretise(rows=rows, min_dt=min_dt, max_dt=max_dt,
-        ##    bucket_width=bucket_width, func_start=func_start,
-        ##    func_end=func_end, cut_oob=cut_oob)
-
-    # for now, we'll do this lazily, and just build on `discretise`
-    # this approach is bad news if the gcd of the two times is very small
-    # it can mean that we end up with a very long list
-    #
-    # approach:
-    # we generate a bunch of (djsoint) "mini" buckets, which we then aggregate
-    # in an overlapping manner
-
-    divisor_secs = fractions.gcd(bucket_width.total_seconds(), increment.total_seconds())
-    mini_bucket_width = timedelta(seconds=divisor_secs)
-    mini_bucksnaps = discretise(
-        rows=rows, min_dt=min_dt, max_dt=max_dt,
-        bucket_width=mini_bucket_width,
-        func_start=func_start, func_end=func_end, cut_oob=cut_oob)
-
-    num_compose_bucks = bucket_width.total_seconds() // mini_bucket_width.total_seconds()
-        # number of mini-windows that need to be aggregated to make a
-        # macro window
-    assert num_compose_bucks >= 1
-    assert num_compose_bucks == int(num_compose_bucks)
-    num_compose_bucks = int(num_compose_bucks)
-
-    # Now we have the setup for the next step...
-    # aggr_num: number of consecutive buckets we compose
-    # mini_bucksnaps: smaller disjoint buckets
-
-    ##bucksnaps_out = OrderedDict()
-    items = mini_bucksnaps.items()
-    for i in xrange(len(items)-num_compose_bucks):
-        dt_start = items[i][0]
-        window = []
-        for j in xrange(num_compose_bucks):
-            window.extend(items[i+j][1])
-        yield dt_start, window
-        ##bucksnaps_out[dt_start] = window
-    ##return bucksnaps_out
+    # since rows are sorted by start time (but not end time), rows enter the
+    # window in order but may leave it in any order. a min-heap of
+    # (leave time, sequence number) pairs gives the next row to leave.
+    # a row has left window [t, t+bucket_width) if its leave time is <= t.
+    # for a half-open interval this is its end time. an event is still in
+    # the window if it occurs at t, so it leaves one microsecond later
+
+    def __init__(self, rows, min_dt, bucket_width, increment,
+                 func_start, func_end, on_enter=None, on_leave=None):
+        self.win_left = min_dt
+        self.win_right = min_dt + bucket_width
+        self.increment = increment
+        self.func_start = func_start
+        self.func_end = func_end
+        self.on_enter = on_enter
+        self.on_leave = on_leave
+        self.it = iter(rows)
+        self.buffer = OrderedDict()
+        self.leave_heap = []
+        self.seq = 0
+        self.next_row = None
+        self.next_start = None
+        self.next_leave = None
+        self.pull_row()
+        self.update_buffer()
+
+    def pull_row(self):
+        # advance the lookahead row. `next_row` is None once `rows` is
+        # exhausted
+        last_start = self.next_start
+        self.next_row = next(self.it, None)
+        if self.next_row is None:
+            return
+
+        start = self.func_start(self.next_row)
+        end = self.func_end(self.next_row)
+        if (last_start is not None) and (start < last_start):
+            raise ValueError("`rows` must be sorted by start time")
+        if not (start <= end):
+            raise ValueError("Unexpected negative-duration interval: [%s, %s)" % (start, end))
+        self.next_start = start
+        self.next_leave = end if start != end else end + timedelta(microseconds=1)
+
+    def buffer_right_fill(self):
+        # fill the buffer with rows starting before the window's right edge
+        while (self.next_row is not None) and (self.next_start < self.win_right):
+            self.buffer[self.seq] = self.next_row
+            heapq.heappush(self.leave_heap, (self.next_leave, self.seq))
+            self.seq += 1
+            if self.on_enter is not None:
+                self.on_enter(self.next_row)
+            self.pull_row()
+
+    def buffer_left_empty(self):
+        # remove rows that have left by the window's left edge
+        while self.leave_heap and (self.leave_heap[0][0] <= self.win_left):
+            _, seq = heapq.heappop(self.leave_heap)
+            row = self.buffer.pop(seq)
+            if self.on_leave is not None:
+                self.on_leave(row)
+
+    def update_buffer(self):
+        self.buffer_right_fill()
+        self.buffer_left_empty()
+
+    def slide_window(self):
+        self.win_left += self.increment
+        self.win_right += self.increment
+        self.update_buffer()
+
+    def get_bucket(self):
+        return (self.win_left, list(self.buffer.values()))
 
 
 def discretise_generic(rows, min_dt, max_dt, bucket_width, increment,
@@ -394,10 +1252,20 @@ def discretise_generic(rows, min_dt, max_dt, bucket_width, increment,
     "bucket snapshot" (bucksnaps) pairs. Each pair represents a particular time window:
         window start datetime, list of samples.
     Much more efficient than all other implementations.
-        
-    CURRENT LIMITATION:
-    Does NOT permit "rows" to be an iterator. Must be concrete list. However, with a
-    buffer-and-lookahead class, this is a possible improvement.
+
+    `rows` may be any iterable (e.g., a database cursor, or a generator over
+    a large file), but must be sorted by start time. Rows are consumed
+    lazily, and only the rows in the current window are buffered, so memory
+    use is proportional to the size of a window rather than the dataset.
+    Sortedness is checked as rows are consumed; a ValueError is raised on
+    encountering an out-of-order row.
+
+    Rows may be intervals, with the same half-open [start, end) semantics
+    as `discretise`: a row appears in every window its interval touches.
+    Within a window, rows are ordered by start time.
+
+    If only a summary of each window is needed (e.g., the number of rows),
+    see `discretise_generic_aggregate`.
     
     TO DO:
     This function will replace all discretisation functions.
@@ -410,86 +1278,20 @@ def discretise_generic(rows, min_dt, max_dt, bucket_width, increment,
         func_start = lambda row: row[0]
     if func_end is None:
         func_end = lambda row: row[1]
-        
-    assert all(func_start(rows[i]) <= func_start(rows[i+1]) for i in xrange(len(rows) - 1)), "must be sorted"
-        # this requires `rows` as concrete list rather than iterator
-    
-    #
-    # currently only supports EVENTS (i.e., zero-duration intervals)
-    for row in rows:
-        assert (func_end(row) - func_start(row)).total_seconds() == 0
-          
-    #
-    # write as class for simplicity
-    class Wrapper(object):
-        # i_right = None means "take everything after i_left"
-        # i_left = None means nothing left to take"
-        # rows[i_left:i_right] are the contents of the window
-        # NOT inclusive at i_right
-        
-        def __init__(self):
-            self.win_left = min_dt
-            self.win_right = min_dt + bucket_width
-            self.N = len(rows)
-            if self.N == 0:
-                self.i_left = 0
-                self.i_right = -1
-            else:
-                self.i_left = 0
-                self.i_right = -1
-            self.update_buffer_indices()
-        
-        def buffer_right_fill(self):
-            # fill the buffer with more values from the right
-            while True:
-                #print 'N=', self.N, '   i_right=', self.i_right
-                if (self.i_right+1) >= self.N:
-                    break
-                elif func_start(rows[self.i_right+1]) < self.win_right:
-                    self.i_right += 1
-                else:
-                    break
-                        
-        def buffer_left_empty(self):
-            # remove values from the left
-            while True:
-                #print 'N=', self.N, '   i_left=', self.i_left
-                if self.i_left >= self.N:
-                    break
-                elif func_start(rows[self.i_left]) < self.win_left:
-                    self.i_left += 1
-                else:
-                    break
-        
-        def update_buffer_indices(self):
-            # update i_left and i_right to their correction positions
-            self.buffer_right_fill()
-            self.buffer_left_empty()
-            
-        def slide_window(self):
-            self.win_left += increment
-            self.win_right += increment
-            self.update_buffer_indices()
-            
-        def get_bucket(self):
-            #print self.i_left, self.i_right
-            window = rows[self.i_left:self.i_right+1]
-            return (self.win_left, window)
 
-    obj = Wrapper()
+    obj = _SlidingWindow(rows, min_dt, bucket_width, increment,
+                         func_start, func_end)
     while obj.win_right < max_dt:
         # get the current bucket
         left_dt, buckets = obj.get_bucket()
         
         # validation checks
         if len(buckets) > 0:
-            right_dt = left_dt + bucket_width
-            assert left_dt <= func_start(buckets[0])
-            assert func_start(buckets[-1]) < right_dt, buckets[-1]
-        if obj.i_left > 0:
-            assert func_start(rows[obj.i_left-1]) < left_dt
-        if obj.i_right < (len(rows)-1):
-            assert func_start(rows[obj.i_right+1]) >= obj.win_right
+            assert func_start(buckets[-1]) < obj.win_right, buckets[-1]
+        if obj.leave_heap:
+            assert obj.leave_heap[0][0] > left_dt
+        if obj.next_row is not None:
+            assert obj.next_start >= obj.win_right
         
         # yield
         yield left_dt, buckets
@@ -498,6 +1300,156 @@ def discretise_generic(rows, min_dt, max_dt, bucket_width, increment,
         obj.slide_window()
 
 
+#
+#
+# Incremental reducers, for use with `discretise_generic_aggregate`.
+# A reducer summarises the rows in a window. It is updated as each row enters
+# (`add`) and leaves (`remove`) the window, and `value` gives the summary of
+# the window's current rows.
+#
+
+
+class CountReducer(object):
+    """
+    Number of rows in the window.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, row):
+        self.count += 1
+
+    def remove(self, row):
+        self.count -= 1
+
+    def value(self):
+        return self.count
+
+
+class SumReducer(object):
+    """
+    Sum of `func_value(row)` over rows in the window.
+    """
+
+    def __init__(self, func_value):
+        self.func_value = func_value
+        self.total = 0
+
+    def add(self, row):
+        self.total += self.func_value(row)
+
+    def remove(self, row):
+        self.total -= self.func_value(row)
+
+    def value(self):
+        return self.total
+
+
+class MeanReducer(object):
+    """
+    Mean of `func_value(row)` over rows in the window. None if the window is
+    empty.
+    """
+
+    def __init__(self, func_value):
+        self.func_value = func_value
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, row):
+        self.total += self.func_value(row)
+        self.count += 1
+
+    def remove(self, row):
+        self.total -= self.func_value(row)
+        self.count -= 1
+
+    def value(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+class DistinctCountReducer(object):
+    """
+    Number of distinct values of `func_value(row)` (which must be hashable)
+    over rows in the window.
+    """
+
+    def __init__(self, func_value):
+        self.func_value = func_value
+        self.counts = collections.defaultdict(int)
+
+    def add(self, row):
+        self.counts[self.func_value(row)] += 1
+
+    def remove(self, row):
+        key = self.func_value(row)
+        self.counts[key] -= 1
+        if self.counts[key] == 0:
+            del self.counts[key]
+
+    def value(self):
+        return len(self.counts)
+
+
+def discretise_generic_aggregate(rows, min_dt, max_dt, bucket_width, increment,
+               reducer='count', func_value=None,
+               func_start=None, func_end=None):
+    """
+    A version of `discretise_generic` that yields a summary of each window's
+    rows, rather than a list of the rows themselves. Yields
+        window start datetime, aggregate value
+    pairs.
+
+    The aggregate is maintained incrementally: the reducer is updated only as
+    rows enter and leave the window, so no per-window lists are built. This
+    makes long windows with small increments (e.g., 24-hour windows at
+    1-minute increments) cheap.
+
+    :Params:
+    reducer:
+        Either the name of a built-in reducer ('count', 'sum', 'mean',
+        'distinct'), or an object with methods `add(row)`, `remove(row)`
+        and `value()` (see `CountReducer` for an example).
+
+    func_value:
+        For the 'sum', 'mean' and 'distinct' built-in reducers, a function
+        that returns the value of a row to be aggregated.
+
+    Other parameters are as for `discretise_generic`.
+    """
+    assert increment <= bucket_width
+    assert increment > timedelta()
+    assert bucket_width > timedelta()
+
+    if func_start is None:
+        func_start = lambda row: row[0]
+    if func_end is None:
+        func_end = lambda row: row[1]
+
+    named_reducers = {
+        'count': lambda: CountReducer(),
+        'sum': lambda: SumReducer(func_value),
+        'mean': lambda: MeanReducer(func_value),
+        'distinct': lambda: DistinctCountReducer(func_value),
+    }
+    if reducer in named_reducers:
+        if (reducer != 'count') and (func_value is None):
+            raise ValueError("Reducer '%s' requires `func_value`" % reducer)
+        reducer = named_reducers[reducer]()
+    elif isinstance(reducer, str):
+        raise ValueError("Unknown reducer '%s'; choose from: %s" % (reducer, ', '.join(sorted(named_reducers))))
+
+    obj = _SlidingWindow(rows, min_dt, bucket_width, increment,
+                         func_start, func_end,
+                         on_enter=reducer.add, on_leave=reducer.remove)
+    while obj.win_right < max_dt:
+        yield obj.win_left, reducer.value()
+        obj.slide_window()
+
+
 if __name__ == "__main__":
     import random
 
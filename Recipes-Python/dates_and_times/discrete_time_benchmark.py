@@ -0,0 +1,353 @@
+# Author:   Matt J Williams
+#           http://www.mattjw.net
+#           mattjw@mattjw.net
+# Date:     2015
+# License:  MIT License
+
+"""
+Benchmarks for the discretisation engines in `discrete_time`.
+
+Synthetic rows (events or intervals) are generated, and each engine is run
+over them for a sweep of bucket widths and increments. For each run, the
+following are reported:
+    * throughput (rows per second),
+    * increase in peak resident set size (RSS) while running the engine,
+    * peak traced allocations (if `tracemalloc` is available and
+      --trace-allocs is given; this slows the engines down),
+    * whether the engine's output matches that of the other engines.
+
+Each run takes place in a fresh child process, so that peak RSS is measured
+for that engine alone. Outputs are compared via a digest of each window's
+(start time, number of rows, sum of row ids), over the windows that every
+engine produces (those that end before `max_dt`).
+
+Example:
+    python discrete_time_benchmark.py --sizes 10000 100000 \\
+        --widths 60 1440 --increments 10 60
+"""
+
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import multiprocessing
+import random
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+
+import discrete_time
+
+
+#
+#
+# Synthetic data
+#
+
+
+def generate_rows(kind, num_rows, min_dt, max_dt, mean_duration, seed=0):
+    """
+    Generate `num_rows` rows, sorted by start time. Each row is a tuple
+        (start datetime, end datetime, row id)
+    with start times uniformly distributed in [min_dt, max_dt), and row ids
+    0, 1, 2, ... in order.
+
+    If `kind` is 'events', rows are zero-duration. If 'intervals', durations
+    are exponentially distributed with mean `mean_duration` (a timedelta).
+    """
+    rnd = random.Random(seed)
+    span_secs = (max_dt - min_dt).total_seconds()
+    offsets = sorted(rnd.uniform(0, span_secs) for _ in range(num_rows))
+
+    rows = []
+    if kind == 'events':
+        for indx, offset in enumerate(offsets):
+            dt = min_dt + timedelta(seconds=offset)
+            rows.append((dt, dt, indx))
+    elif kind == 'intervals':
+        rate = 1.0 / mean_duration.total_seconds()
+        for indx, offset in enumerate(offsets):
+            dt1 = min_dt + timedelta(seconds=offset)
+            dt2 = dt1 + timedelta(seconds=rnd.expovariate(rate))
+            rows.append((dt1, dt2, indx))
+    else:
+        raise ValueError("Unknown kind '%s'; choose from: events, intervals" % kind)
+    return rows
+
+
+#
+#
+# Engines
+#
+# Each engine is a function of (rows, min_dt, max_dt, width, increment) that
+# yields (window start, number of rows, sum of row ids) triples.
+#
+
+
+def _summarise(windows):
+    for dt, window in windows:
+        yield dt, len(window), sum(row[2] for row in window)
+
+
+def engine_discretise(rows, min_dt, max_dt, width, increment):
+    buckets = discrete_time.discretise(rows, min_dt, max_dt, width, cut_oob=True)
+    return _summarise(buckets.items())
+
+
+def engine_discretise_compact(rows, min_dt, max_dt, width, increment):
+    buckets = discrete_time.discretise(rows, min_dt, max_dt, width, cut_oob=True,
+                                       compact=True)
+    return _summarise(buckets.iteritems())
+
+
+def engine_discretise_parallel(rows, min_dt, max_dt, width, increment):
+    buckets = discrete_time.discretise_parallel(rows, min_dt, max_dt, width,
+                                                cut_oob=True)
+    return _summarise(buckets.items())
+
+
+def engine_discretise_arrays(rows, min_dt, max_dt, width, increment):
+    import numpy as np
+    starts = np.array([row[0] for row in rows], dtype='datetime64[us]')
+    ends = np.array([row[1] for row in rows], dtype='datetime64[us]')
+    bucket_times, _, _, row_indptr, row_buckets = discrete_time.discretise_arrays(
+        starts, ends, min_dt, max_dt, width, cut_oob=True)
+
+    row_ids = np.repeat(np.arange(len(rows)), np.diff(row_indptr))
+    counts = np.bincount(row_buckets, minlength=len(bucket_times))
+    id_sums = np.bincount(row_buckets, weights=row_ids, minlength=len(bucket_times))
+    for dt, count, id_sum in zip(bucket_times, counts, id_sums):
+        yield dt.astype(datetime), int(count), int(id_sum)
+
+
+def engine_discretise_nondisjoint(rows, min_dt, max_dt, width, increment):
+    buckets = discrete_time.discretise_nondisjoint(rows, min_dt, max_dt, width,
+                                                   increment, cut_oob=True)
+    return _summarise(buckets.items())
+
+
+def engine_discretise_nondisjoint_generator(rows, min_dt, max_dt, width, increment):
+    windows = discrete_time.discretise_nondisjoint_generator(
+        rows, min_dt, max_dt, width, increment, cut_oob=True)
+    return _summarise(windows)
+
+
+def engine_discretise_generic(rows, min_dt, max_dt, width, increment):
+    windows = discrete_time.discretise_generic(iter(rows), min_dt, max_dt,
+                                               width, increment)
+    return _summarise(windows)
+
+
+class _CountAndIdSumReducer(object):
+
+    def __init__(self):
+        self.count = 0
+        self.id_sum = 0
+
+    def add(self, row):
+        self.count += 1
+        self.id_sum += row[2]
+
+    def remove(self, row):
+        self.count -= 1
+        self.id_sum -= row[2]
+
+    def value(self):
+        return self.count, self.id_sum
+
+
+def engine_discretise_generic_aggregate(rows, min_dt, max_dt, width, increment):
+    windows = discrete_time.discretise_generic_aggregate(
+        iter(rows), min_dt, max_dt, width, increment,
+        reducer=_CountAndIdSumReducer())
+    for dt, (count, id_sum) in windows:
+        yield dt, count, id_sum
+
+
+DISJOINT_ENGINES = [
+    ('discretise', engine_discretise),
+    ('discretise[compact]', engine_discretise_compact),
+    ('discretise_parallel', engine_discretise_parallel),
+    ('discretise_arrays', engine_discretise_arrays),
+]
+    # engines that only support increment == width
+
+ALL_ENGINES = DISJOINT_ENGINES + [
+    ('discretise_nondisjoint', engine_discretise_nondisjoint),
+    ('discretise_nondisjoint_generator', engine_discretise_nondisjoint_generator),
+    ('discretise_generic', engine_discretise_generic),
+    ('discretise_generic_aggregate', engine_discretise_generic_aggregate),
+]
+
+
+#
+#
+# Measurement
+#
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (but bytes on OS X)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def _run_engine(engine_func, data_args, min_dt, max_dt, width, increment,
+                trace_allocs, results):
+    """
+    Body of the child process for a single benchmark run. Puts
+        (seconds, RSS increase MB, peak traced allocations MB, digest)
+    on the `results` queue, or an error message if the engine fails.
+    """
+    try:
+        results.put(_measure_engine(engine_func, data_args, min_dt, max_dt,
+                                    width, increment, trace_allocs))
+    except Exception as e:
+        results.put("%s: %s" % (type(e).__name__, e))
+
+
+def _measure_engine(engine_func, data_args, min_dt, max_dt, width, increment,
+                    trace_allocs):
+    rows = generate_rows(*data_args)
+    rss_before = _peak_rss_mb()
+
+    tracemalloc = None
+    if trace_allocs:
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            tracemalloc = None
+
+    digest = hashlib.md5()
+    t0 = time.time()
+    for dt, count, id_sum in engine_func(rows, min_dt, max_dt, width, increment):
+        if dt + width < max_dt:
+            # only windows that every engine produces
+            digest.update(repr((dt, count, id_sum)).encode('ascii'))
+    secs = time.time() - t0
+
+    alloc_mb = None
+    if tracemalloc is not None:
+        alloc_mb = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+        tracemalloc.stop()
+
+    return secs, _peak_rss_mb() - rss_before, alloc_mb, digest.hexdigest()
+
+
+def benchmark(engine_func, data_args, min_dt, max_dt, width, increment,
+              trace_allocs=False):
+    """
+    Run a single engine in a child process, returning
+        (seconds, RSS increase MB, peak traced allocations MB, digest).
+    Raises RuntimeError if the engine fails, or if the child process dies
+    without a result (e.g., if it is killed for running out of memory).
+    """
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=_run_engine,
+        args=(engine_func, data_args, min_dt, max_dt, width, increment,
+              trace_allocs, results))
+    proc.start()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=1.0)
+                break
+            except Queue.Empty:
+                if not proc.is_alive():
+                    # the child may have put its result just before exiting
+                    try:
+                        result = results.get(timeout=1.0)
+                        break
+                    except Queue.Empty:
+                        raise RuntimeError("child process exited with code %s" % proc.exitcode)
+    finally:
+        proc.join()
+    if isinstance(result, str):
+        raise RuntimeError(result)
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the discrete_time engines.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5],
+                        help='numbers of rows (e.g., 10000 up to 100000000)')
+    parser.add_argument('--kinds', nargs='+', default=['events', 'intervals'],
+                        choices=['events', 'intervals'],
+                        help='kinds of synthetic rows')
+    parser.add_argument('--widths', type=float, nargs='+', default=[60, 1440],
+                        help='bucket widths, in minutes (must divide a day)')
+    parser.add_argument('--increments', type=float, nargs='+', default=[10, 60],
+                        help='window increments, in minutes')
+    parser.add_argument('--days', type=float, default=7,
+                        help='duration of the synthetic data, in days')
+    parser.add_argument('--mean-duration', type=float, default=30,
+                        help='mean duration of interval rows, in minutes')
+    parser.add_argument('--engines', nargs='+', default=None,
+                        choices=[name for name, _ in ALL_ENGINES],
+                        help='engines to run (default: all)')
+    parser.add_argument('--trace-allocs', action='store_true',
+                        help='also report peak allocations via tracemalloc (slow)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+
+    min_dt = datetime(2015, 1, 1)
+    max_dt = min_dt + timedelta(days=args.days)
+    mean_duration = timedelta(minutes=args.mean_duration)
+
+    print("%-8s  %-10s  %-8s  %-8s  %-34s  %10s  %12s  %9s  %9s  %s" % (
+        'kind', 'rows', 'width', 'incr', 'engine', 'secs', 'rows/sec',
+        'rss MB', 'alloc MB', 'output'))
+
+    all_match = True
+    for kind in args.kinds:
+        for num_rows in args.sizes:
+            data_args = (kind, num_rows, min_dt, max_dt, mean_duration, args.seed)
+            for width_mins in args.widths:
+                for incr_mins in args.increments:
+                    if incr_mins > width_mins:
+                        continue
+                    width = timedelta(minutes=width_mins)
+                    increment = timedelta(minutes=incr_mins)
+
+                    engines = ALL_ENGINES if (width == increment) else ALL_ENGINES[len(DISJOINT_ENGINES):]
+                    if args.engines is not None:
+                        engines = [(name, func) for name, func in engines if name in args.engines]
+
+                    ref_digest = None
+                    for name, func in engines:
+                        row_prefix = "%-8s  %-10d  %-8s  %-8s  %-34s" % (
+                            kind, num_rows, '%gm' % width_mins, '%gm' % incr_mins, name)
+                        try:
+                            secs, rss_mb, alloc_mb, digest = benchmark(
+                                func, data_args, min_dt, max_dt, width, increment,
+                                trace_allocs=args.trace_allocs)
+                        except RuntimeError as e:
+                            all_match = False
+                            print("%s  ERROR %s" % (row_prefix, e))
+                            continue
+
+                        if ref_digest is None:
+                            ref_digest = digest
+                        match = (digest == ref_digest)
+                        all_match = all_match and match
+
+                        print("%s  %10.3f  %12.0f  %9.1f  %9s  %s" % (
+                            row_prefix, secs, num_rows / max(secs, 1e-9), rss_mb,
+                            '-' if alloc_mb is None else '%.1f' % alloc_mb,
+                            'ok' if match else 'MISMATCH'))
+
+    return 0 if all_match else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
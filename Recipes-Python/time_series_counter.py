@@ -12,10 +12,270 @@
 
 
 import collections
+import functools
+import hashlib
+import heapq
+import math
+import multiprocessing
+import struct
+import numpy as np
 import pandas as pd
+import pytz
 import datetime
 
 
+_ORIGIN = datetime.datetime(1970, 1, 5)
+    # origin of the bucket grid. a Monday, so that weekly buckets begin on
+    # Mondays
+_ORIGIN_UTC = _ORIGIN.replace(tzinfo=pytz.utc)
+
+_MINS_PER_DAY = 24 * 60
+_MINS_PER_WEEK = 7 * _MINS_PER_DAY
+
+_EPOCH_UNITS = ('s', 'ms', 'us', 'ns')
+
+
+def _serialise(obj, chunks):
+    """
+    Append a byte serialisation of hashable `obj` to list `chunks`, for
+    hashing. Each value is written as a type tag, the length of its payload,
+    and the payload, so that objects of different types don't collide (e.g.,
+    1 and '1'). Objects that are equal as set members serialise the same
+    (e.g., 1, 1L, 1.0, and True; or 'a' and u'a'), so the approximate count
+    of unique objects agrees with the exact (set-based) count. Frozensets
+    are ordered by the serialisations of their items, so the serialisation
+    is the same in every process.
+    """
+    if isinstance(obj, bool):
+        obj = int(obj)
+    elif isinstance(obj, float) and obj.is_integer():
+        obj = int(obj)
+
+    if obj is None:
+        tag, payload = 'n', ''
+    elif isinstance(obj, (int, long)):
+        tag, payload = 'i', str(obj)
+    elif isinstance(obj, float):
+        tag, payload = 'f', repr(obj)
+    elif isinstance(obj, unicode):
+        tag, payload = 's', obj.encode('utf-8')
+    elif isinstance(obj, str):
+        tag, payload = 's', obj
+    elif isinstance(obj, tuple):
+        chunks.append('t%d:' % len(obj))
+        for item in obj:
+            _serialise(item, chunks)
+        return
+    elif isinstance(obj, frozenset):
+        items = []
+        for item in obj:
+            item_chunks = []
+            _serialise(item, item_chunks)
+            items.append(''.join(item_chunks))
+        chunks.append('z%d:' % len(items))
+        chunks.extend(sorted(items))
+        return
+    else:
+        # other hashable objects (e.g., datetimes); assumes a stable repr
+        tag, payload = 'r', '%s.%s:%r' % (type(obj).__module__, type(obj).__name__, obj)
+    chunks.append('%s%d:' % (tag, len(payload)))
+    chunks.append(payload)
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch, for approximately counting the number of distinct
+    objects in a stream, in bounded memory.
+
+    The sketch uses 2**`precision` one-byte registers (e.g., 4 KB for the
+    default precision of 12). The relative standard error of the estimate is
+    about
+        1.04 / sqrt(2**precision),
+    e.g., 1.6% for precision 12, or 0.8% for precision 14. Estimates for
+    small numbers of distinct objects use linear counting, and are more
+    accurate.
+
+    Sketches of the same precision can be merged; the result is the same as
+    a sketch of the union of both streams.
+
+    See: Flajolet et al., "HyperLogLog: the analysis of a near-optimal
+    cardinality estimation algorithm", 2007.
+    """
+
+    def __init__(self, precision=12):
+        if not (4 <= precision <= 16):
+            raise ValueError("Precision must be between 4 and 16")
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    @staticmethod
+    def _hash(obj):
+        # a 64-bit hash, which (unlike `hash`) is the same in every process
+        chunks = []
+        _serialise(obj, chunks)
+        return struct.unpack('>Q', hashlib.md5(''.join(chunks)).digest()[:8])[0]
+
+    def add(self, obj):
+        """
+        Add hashable object `obj` to the sketch.
+        """
+        h = self._hash(obj)
+        num_rest_bits = 64 - self.precision
+        indx = h >> num_rest_bits
+        rest = h & ((1 << num_rest_bits) - 1)
+        rank = num_rest_bits - rest.bit_length() + 1  # leading zeros, plus one
+        if rank > self._registers[indx]:
+            self._registers[indx] = rank
+
+    def update(self, objs):
+        """
+        Add each object in `objs` to the sketch.
+        """
+        for obj in objs:
+            self.add(obj)
+
+    def merge(self, other):
+        """
+        Merge HyperLogLog `other` into this sketch.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        self._registers = bytearray(max(a, b) for a, b in zip(self._registers, other._registers))
+
+    def count(self):
+        """
+        Estimated number of distinct objects added.
+        """
+        m = len(self._registers)
+        if m >= 128:
+            alpha = 0.7213 / (1.0 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self._registers)
+        num_zeros = self._registers.count(b'\x00')
+        if (estimate <= 2.5 * m) and (num_zeros > 0):
+            # small range correction: linear counting
+            estimate = m * math.log(float(m) / num_zeros)
+        return estimate
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving sketch, for approximately tracking the most frequent items
+    in a stream (the "heavy hitters"), in bounded memory.
+
+    At most `capacity` items are tracked. When a new item arrives and the
+    sketch is full, the item with the smallest count is evicted, and the new
+    item inherits its count (recorded as the new item's error). Each item's
+    estimated count is therefore an overestimate of its true count by at
+    most its error, and by at most N / `capacity` in a stream of N items. Any
+    item with a true count above N / `capacity` is guaranteed to be tracked.
+
+    Sketches can be merged; the merged estimates keep the same guarantees.
+
+    See: Metwally et al., "Efficient computation of frequent and top-k
+    elements in data streams", 2005.
+    """
+
+    def __init__(self, capacity=100):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._heap = []
+            # (count, item) pairs, for finding the item with the smallest
+            # count. entries are updated lazily, so may understate counts
+
+    def add(self, item, count=1):
+        """
+        Add `count` occurrences of hashable `item` to the sketch.
+        """
+        if item in self._counts:
+            self._counts[item] += count
+            return
+
+        error = 0
+        if len(self._counts) >= self.capacity:
+            error = self._evict_min()
+        self._counts[item] = error + count
+        self._errors[item] = error
+        heapq.heappush(self._heap, (error + count, item))
+
+    def update(self, items):
+        """
+        Add each item in `items` to the sketch.
+        """
+        for item in items:
+            self.add(item)
+
+    def _evict_min(self):
+        """
+        Remove the item with the smallest count; returns its count.
+        """
+        while True:
+            count, item = heapq.heappop(self._heap)
+            if self._counts.get(item) == count:
+                del self._counts[item]
+                del self._errors[item]
+                return count
+            elif item in self._counts:
+                # stale entry
+                heapq.heappush(self._heap, (self._counts[item], item))
+
+    def _min_count(self):
+        # an upper bound on the count of any untracked item
+        if len(self._counts) < self.capacity:
+            return 0
+        return min(self._counts.itervalues())
+
+    def merge(self, other):
+        """
+        Merge Space-Saving sketch `other` into this sketch.
+        """
+        if other.capacity != self.capacity:
+            raise ValueError("Cannot merge sketches of different capacity")
+
+        # an item untracked by a sketch may have occurred up to that sketch's
+        # smallest count times
+        self_min = self._min_count()
+        other_min = other._min_count()
+        merged = []
+        for item in set(self._counts) | set(other._counts):
+            count = self._counts.get(item, self_min) + other._counts.get(item, other_min)
+            error = self._errors.get(item, self_min) + other._errors.get(item, other_min)
+            merged.append((count, error, item))
+        merged = heapq.nlargest(self.capacity, merged, key=lambda entry: entry[0])
+
+        self._counts = dict((item, count) for count, _, item in merged)
+        self._errors = dict((item, error) for _, error, item in merged)
+        self._heap = [(count, item) for count, _, item in merged]
+        heapq.heapify(self._heap)
+
+    def top(self, n=None):
+        """
+        List of the `n` (default: all tracked) items with the largest
+        estimated counts, as (item, estimated count, max error) triples, in
+        descending order of count.
+        """
+        entries = [(item, count, self._errors[item]) for item, count in self._counts.iteritems()]
+        entries.sort(key=lambda entry: entry[1], reverse=True)
+        return entries if n is None else entries[:n]
+
+
+def _object_array(values):
+    """
+    1-D numpy object array of the elements of sequence `values`. (Unlike
+    `np.asarray(values, dtype=object)`, which makes a 2-D array of a list of
+    tuples, each element is kept whole.)
+    """
+    values = list(values)
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+
 class TimeSeriesBuilder(object):
     """
     Simple helper for constructing a time series of counts (tweet volume,
@@ -31,43 +291,105 @@ class TimeSeriesBuilder(object):
     Example use case #2:
     As with #1, except you want to only track the number of (unique) users
     who've tweeted in each hour.
+
+    Tracking unique objects exactly requires keeping every object seen in
+    each timestep. If `approx_uniques` is True, each timestep instead keeps
+    a HyperLogLog sketch of 2**`hll_precision` bytes, and the count of unique
+    objects is estimated (see `HyperLogLog` for the error bound).
+
+    If `top_k` is given, the builder also tracks the `top_k` most frequent
+    items (e.g., hashtags) in each timestep, from the `item` given with each
+    sample; see `heavy_hitters`. Each timestep keeps a SpaceSaving sketch of
+    at most `top_k_capacity` items (default: 10 * `top_k`), so memory is
+    bounded however many distinct items there are.
+
+    If `lateness_mins` is given, the builder runs in streaming mode, for
+    unbounded streams of samples that may arrive somewhat out of order. The
+    watermark trails the latest sample time seen by `lateness_mins` minutes.
+    Once a timestep ends at or before the watermark, it is finalised: its
+    count is passed to `on_flush(dt, count)` (or, if `on_flush` is None,
+    queued for `pop_finalised`), and its state is evicted, so memory stays
+    bounded. If `top_k` is given, the timestep's heavy hitters, as a list of
+    (item, estimated count) pairs, are passed as a third argument.
+    Samples that arrive for an already finalised timestep are late; per
+    `late_policy`, they are either dropped ('drop') or counted separately
+    ('side'; see `late_counts`). In streaming mode, `to_series` only covers
+    the open timesteps.
     """
 
-    def __init__(self, bucket_width_mins=60):
+    def __init__(self, bucket_width_mins=60, approx_uniques=False,
+                 hll_precision=12, top_k=None, top_k_capacity=None,
+                 lateness_mins=None, on_flush=None, late_policy='drop'):
         if int(bucket_width_mins) != bucket_width_mins:
             raise ValueError("Bucket width must be int")
         bucket_width_mins = int(bucket_width_mins)
 
-        if bucket_width_mins == 0:
+        if bucket_width_mins <= 0:
             raise ValueError("Bucket width must be positive")
-        if bucket_width_mins > 60:
-            raise ValueError("Bucket width must be no greater than 60 mins")
-        if (60 % bucket_width_mins) != 0:
-            raise NotImplementedError("Bucket width must be divisor of 60 minutes")
+        if ((_MINS_PER_DAY % bucket_width_mins) != 0) and (bucket_width_mins != _MINS_PER_WEEK):
+            raise NotImplementedError("Bucket width must be a divisor of one day (1440 minutes), or one week (10080 minutes)")
 
-        self._counts = collections.defaultdict(lambda: 0.0)
-        self._uniqs = collections.defaultdict(lambda: set())
+        # no lambdas as default factories, so that builders can be pickled
+        # (e.g., to return them from worker processes)
+        self._counts = collections.defaultdict(float)
+        self._uniqs = collections.defaultdict(set)
+        self._sketches = collections.defaultdict(functools.partial(HyperLogLog, hll_precision))
         self._bucket_width_mins = bucket_width_mins
+        self._approx_uniques = approx_uniques
+        self._hll_precision = hll_precision
 
-    def increment_at(self, dt, obj=None):
+        if top_k is not None:
+            if top_k < 1:
+                raise ValueError("top_k must be positive")
+            if top_k_capacity is None:
+                top_k_capacity = 10 * top_k
+            if top_k_capacity < top_k:
+                raise ValueError("top_k_capacity must be at least top_k")
+        self._top_k = top_k
+        self._top_k_capacity = top_k_capacity
+        self._top_items = collections.defaultdict(functools.partial(SpaceSaving, top_k_capacity))
+
+        if lateness_mins is not None and lateness_mins < 0:
+            raise ValueError("lateness_mins must be non-negative")
+        if late_policy not in ('drop', 'side'):
+            raise ValueError("Unknown late policy '%s'; choose from: drop, side" % late_policy)
+        self._lateness_mins = lateness_mins
+        self._on_flush = on_flush
+        self._late_policy = late_policy
+        self._watermark = None
+        self._open_heap = []
+        self._open_set = set()
+            # open (not yet finalised) timesteps, in streaming mode
+        self._finalised = collections.deque()
+        self._late_counts = collections.defaultdict(float)
+
+    def increment_at(self, dt, obj=None, item=None):
         """
         Increment the count at time `dt`.
         If `obj` is not None, the count is only incremented if `obj` has not
         been seen in this timestep before.
+        If `item` is not None, it is tallied towards the timestep's heavy
+        hitters (requires `top_k`).
         """
-        if self._bucket_width_mins == 60:
-            dt = dt.replace(minute=0, second=0, microsecond=0)
-        elif 1 <= self._bucket_width_mins <= 60:
-            #print "~", dt,
-            mins = dt.minute
-            floored = (mins // self._bucket_width_mins) * self._bucket_width_mins
-            dt = dt.replace(minute=floored, second=0, microsecond=0)
-            #print " -> ", dt, "\n"
-        else:
-            assert False
-
+        sample_dt = dt
+        dt = self._floor(dt)
         assert dt.tzinfo is not None
 
+        if self._lateness_mins is not None:
+            if self._is_late(dt):
+                if self._late_policy == 'side':
+                    self._late_counts[dt] += 1.0
+                return
+            self._open(dt)
+            self._advance_watermark(sample_dt)
+
+        if item is not None:
+            self._top_items_at(dt).add(item)
+
+        if obj is not None and self._approx_uniques:
+            self._sketches[dt].add(obj)
+            return
+
         if obj is not None:
             if obj in self._uniqs[dt]:
                 return
@@ -76,34 +398,464 @@ class TimeSeriesBuilder(object):
 
         self._counts[dt] += 1.0
 
+    def _floor(self, dt):
+        """
+        Floor datetime `dt` to the start of its timestep (in wallclock time).
+        """
+        if self._bucket_width_mins == 60:
+            return dt.replace(minute=0, second=0, microsecond=0)
+        elif (60 % self._bucket_width_mins) == 0:
+            mins = dt.minute
+            floored = (mins // self._bucket_width_mins) * self._bucket_width_mins
+            return dt.replace(minute=floored, second=0, microsecond=0)
+        else:
+            # widths that don't divide an hour; floor relative to the origin
+            # (a midnight, on a Monday)
+            delta = dt.replace(tzinfo=None) - _ORIGIN
+            mins = delta.days * _MINS_PER_DAY + delta.seconds // 60
+            floored = mins - (mins % self._bucket_width_mins)
+            return self._localize(_ORIGIN + datetime.timedelta(minutes=floored), dt.tzinfo)
+
+    @staticmethod
+    def _localize(naive_dt, tzinfo):
+        """
+        Attach the timezone `tzinfo` to wallclock time `naive_dt`. For pytz
+        timezones, the UTC offset in effect at `naive_dt` is used (rather
+        than that of `tzinfo`, which may be on the other side of a DST
+        shift), so each wallclock time has a single key.
+        """
+        localize = getattr(tzinfo, 'localize', None)
+        if localize is not None:
+            return localize(naive_dt)
+        return naive_dt.replace(tzinfo=tzinfo)
+
+    def _bucket_end(self, dt):
+        """
+        End time of the timestep starting at `dt`.
+        """
+        if (60 % self._bucket_width_mins) == 0:
+            return dt + datetime.timedelta(minutes=self._bucket_width_mins)
+        # timesteps aligned to wallclock midnights end on the wallclock, which
+        # may be more or less than the width away across a DST shift
+        naive_end = dt.replace(tzinfo=None) + datetime.timedelta(minutes=self._bucket_width_mins)
+        return self._localize(naive_end, dt.tzinfo)
+
+    def _top_items_at(self, dt):
+        if self._top_k is None:
+            raise ValueError("Tracking items requires top_k")
+        return self._top_items[dt]
+
+    def increment_many(self, timestamps, objs=None, unit='s', items=None):
+        """
+        Batch version of `increment_at`: increment the count at each time in
+        `timestamps`.
+
+        `timestamps` may be a numpy datetime64 array, a pandas Series or
+        DatetimeIndex of (naive) datetimes, or an array of times since the
+        Unix epoch in units of `unit` ('s', 'ms', 'us', or 'ns'). All times
+        are taken to be UTC, and are counted in UTC buckets.
+
+        If `objs` is not None, it is a sequence of the same length as
+        `timestamps`, and counts are only incremented for objects not yet
+        seen in their timestep (as for `increment_at`). Likewise, if `items`
+        is not None, each item (unless None) is tallied towards its
+        timestep's heavy hitters.
+
+        Timestamps are floored to buckets and counted vectorised; Python-level
+        work is only done once per bucket (or, if `objs` is given, once per
+        bucket to update its set of seen objects, or to tally its items).
+        """
+        micros = self._origin_micros(timestamps, unit)
+        buck_ids = micros // self._width_micros()
+        if len(buck_ids) == 0:
+            return
+
+        if objs is not None:
+            objs = _object_array(objs)
+            if len(objs) != len(buck_ids):
+                raise ValueError("`timestamps` and `objs` must be the same length")
+        if items is not None:
+            items = _object_array(items)
+            if len(items) != len(buck_ids):
+                raise ValueError("`timestamps` and `items` must be the same length")
+
+        if self._lateness_mins is None:
+            self._increment_buckets(buck_ids, objs, items)
+            return
+
+        # streaming mode; samples are late if their timestep was finalised
+        # before this batch
+        if self._watermark is not None:
+            late = (buck_ids + 1) * self._width_micros() <= self._dt_micros(self._watermark)
+            if late.any():
+                if self._late_policy == 'side':
+                    for buck_id, count in collections.Counter(buck_ids[late]).iteritems():
+                        self._late_counts[self._bucket_dt(int(buck_id))] += float(count)
+                on_time = ~late
+                buck_ids = buck_ids[on_time]
+                if objs is not None:
+                    objs = objs[on_time]
+                if items is not None:
+                    items = items[on_time]
+        for buck_id in np.unique(buck_ids):
+            self._open(self._bucket_dt(int(buck_id)))
+        self._increment_buckets(buck_ids, objs, items)
+        self._advance_watermark(_ORIGIN_UTC + datetime.timedelta(microseconds=int(micros.max())))
+
+    def _increment_buckets(self, buck_ids, objs, items):
+        """
+        Body of `increment_many`, given (on-time) bucket ids.
+        """
+        if len(buck_ids) == 0:
+            return
+        first_id = int(buck_ids.min())
+
+        if objs is None and items is None:
+            dense = np.bincount(buck_ids - first_id)
+            for offset in np.flatnonzero(dense):
+                dt = self._bucket_dt(first_id + int(offset))
+                self._counts[dt] += float(dense[offset])
+            return
+
+        # group objects and items by bucket
+        order = np.argsort(buck_ids, kind='mergesort')
+        buck_ids = buck_ids[order]
+        if objs is not None:
+            objs = objs[order]
+        if items is not None:
+            items = items[order]
+        bounds = np.flatnonzero(np.diff(buck_ids)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(buck_ids)]))
+
+        for start, end in zip(starts, ends):
+            dt = self._bucket_dt(int(buck_ids[start]))
+            if items is not None:
+                top_items = self._top_items_at(dt)
+                tallies = collections.Counter(items[start:end])
+                tallies.pop(None, None)
+                for item, count in tallies.iteritems():
+                    top_items.add(item, count)
+
+            if objs is None:
+                self._counts[dt] += float(end - start)
+            elif self._approx_uniques:
+                self._sketches[dt].update(objs[start:end])
+            else:
+                uniqs = self._uniqs[dt]
+                num_before = len(uniqs)
+                uniqs.update(objs[start:end])
+                self._counts[dt] += float(len(uniqs) - num_before)
+
+    def _origin_micros(self, timestamps, unit):
+        """
+        Each timestamp, as an int64 array of microseconds since the origin.
+        """
+        values = np.asarray(timestamps)
+        if np.issubdtype(values.dtype, np.integer):
+            if unit not in _EPOCH_UNITS:
+                raise ValueError("Unknown epoch unit '%s'; choose from: %s" % (unit, ', '.join(_EPOCH_UNITS)))
+            values = values.astype('datetime64[%s]' % unit)
+        micros = np.asarray(values, dtype='datetime64[us]').astype(np.int64)
+        micros -= np.datetime64(_ORIGIN, 'us').astype(np.int64)
+        return micros
+
+    def _width_micros(self):
+        return self._bucket_width_mins * 60 * 10**6
+
+    @staticmethod
+    def _dt_micros(dt):
+        # microseconds since the origin, of aware datetime `dt`
+        delta = dt - _ORIGIN_UTC
+        return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+    def _bucket_ids(self, timestamps, unit):
+        """
+        Bucket of each timestamp, as an int64 array of the number of bucket
+        widths since the origin.
+        """
+        return self._origin_micros(timestamps, unit) // self._width_micros()
+
+    def _bucket_dt(self, buck_id):
+        """
+        Bucket time (UTC) of a bucket id from `_bucket_ids`.
+        """
+        return _ORIGIN_UTC + datetime.timedelta(minutes=buck_id * self._bucket_width_mins)
+
+    def _is_late(self, dt):
+        """
+        Whether timestep `dt` has been finalised (in streaming mode).
+        """
+        return (self._watermark is not None) and (self._bucket_end(dt) <= self._watermark)
+
+    def _open(self, dt):
+        if dt not in self._open_set:
+            self._open_set.add(dt)
+            heapq.heappush(self._open_heap, dt)
+
+    def _advance_watermark(self, sample_dt):
+        """
+        Advance the watermark given a sample at time `sample_dt`, finalising
+        the timesteps that end at or before it.
+        """
+        watermark = sample_dt - datetime.timedelta(minutes=self._lateness_mins)
+        if (self._watermark is not None) and (watermark <= self._watermark):
+            return
+        self._watermark = watermark
+
+        while self._open_heap and (self._bucket_end(self._open_heap[0]) <= watermark):
+            self._finalise(heapq.heappop(self._open_heap))
+
+    def _finalise(self, dt):
+        """
+        Emit the count of timestep `dt`, and evict its state.
+        """
+        self._open_set.discard(dt)
+        count = self._counts.pop(dt, 0.0)
+        self._uniqs.pop(dt, None)
+        sketch = self._sketches.pop(dt, None)
+        if sketch is not None:
+            count += sketch.count()
+
+        flushed = (dt, count)
+        if self._top_k is not None:
+            top_items = self._top_items.pop(dt, None)
+            if top_items is None:
+                flushed += ([],)
+            else:
+                flushed += ([(item, float(item_count)) for item, item_count, _ in top_items.top(self._top_k)],)
+
+        if self._on_flush is not None:
+            self._on_flush(*flushed)
+        else:
+            self._finalised.append(flushed)
+
+    def pop_finalised(self):
+        """
+        Generator of the timesteps finalised (in streaming mode, without an
+        `on_flush` callback) since the last call, in time order, as
+            (dt, count)
+        pairs (or, if `top_k` is given, (dt, count, top items) triples).
+        """
+        while self._finalised:
+            yield self._finalised.popleft()
+
+    def flush_all(self):
+        """
+        Finalise all open timesteps (in streaming mode), e.g., at the end of
+        the stream. Later samples for these timesteps are late.
+        """
+        while self._open_heap:
+            dt = heapq.heappop(self._open_heap)
+            end = self._bucket_end(dt)
+            if (self._watermark is None) or (end > self._watermark):
+                self._watermark = end
+            self._finalise(dt)
+
+    def late_counts(self):
+        """
+        Series of the number of late samples in each timestep (in streaming
+        mode, with late policy 'side'). Unique objects are not tracked for
+        late samples; every late sample is counted.
+        """
+        ser = pd.Series(self._late_counts)
+        ser.index.name = 'snapshot'
+        return ser.sort_index()
+
+    def merge(self, other):
+        """
+        Merge the counts of TimeSeriesBuilder `other` into this builder, as
+        if this builder had also received all of the samples received by
+        `other`. Counts are summed. Unique objects are unioned (or, if
+        approximate, sketches are merged), so an object seen by both builders
+        in the same timestep is only counted once. Heavy hitter sketches are
+        merged.
+
+        Both builders must have the same settings. Returns this builder.
+        """
+        if (self._bucket_width_mins != other._bucket_width_mins) or \
+                (self._approx_uniques != other._approx_uniques) or \
+                (self._approx_uniques and (self._hll_precision != other._hll_precision)) or \
+                (self._top_k != other._top_k) or \
+                (self._top_k_capacity != other._top_k_capacity):
+            raise ValueError("Cannot merge builders with different settings")
+        if (self._lateness_mins is not None) or (other._lateness_mins is not None):
+            raise ValueError("Cannot merge builders in streaming mode")
+
+        for dt, count in other._counts.iteritems():
+            other_uniqs = other._uniqs.get(dt)
+            if other_uniqs:
+                uniqs = self._uniqs[dt]
+                count -= len(uniqs & other_uniqs)  # don't double-count
+                uniqs |= other_uniqs
+            self._counts[dt] += count
+
+        for dt, other_sketch in other._sketches.iteritems():
+            self._sketches[dt].merge(other_sketch)
+
+        for dt, other_top_items in other._top_items.iteritems():
+            self._top_items[dt].merge(other_top_items)
+
+        return self
+
+    def rollup(self, bucket_width_mins):
+        """
+        Return a new TimeSeriesBuilder with a coarser bucket width
+        `bucket_width_mins`, derived exactly from this builder's counts (as if
+        the new builder had received the same samples). The new width must be
+        a multiple of this builder's width.
+
+        This allows series at several resolutions (e.g., minute, hour, day,
+        and week) to be built from a single pass over the samples, counted at
+        the finest resolution.
+        """
+        if (bucket_width_mins % self._bucket_width_mins) != 0:
+            raise ValueError("Bucket width must be a multiple of %s mins" % self._bucket_width_mins)
+
+        coarse = TimeSeriesBuilder(bucket_width_mins,
+                                   approx_uniques=self._approx_uniques,
+                                   hll_precision=self._hll_precision,
+                                   top_k=self._top_k,
+                                   top_k_capacity=self._top_k_capacity)
+
+        for dt, count in self._counts.iteritems():
+            coarse_dt = coarse._floor(dt)
+            uniqs = self._uniqs.get(dt)
+            if uniqs:
+                # unique counts are added once their timesteps are unioned
+                count -= len(uniqs)
+                coarse._uniqs[coarse_dt] |= uniqs
+            coarse._counts[coarse_dt] += count
+
+        for coarse_dt, uniqs in coarse._uniqs.iteritems():
+            coarse._counts[coarse_dt] += len(uniqs)
+
+        for dt, sketch in self._sketches.iteritems():
+            coarse._sketches[coarse._floor(dt)].merge(sketch)
+
+        for dt, top_items in self._top_items.iteritems():
+            coarse._top_items[coarse._floor(dt)].merge(top_items)
+
+        return coarse
+
+    def to_series_rollups(self, bucket_widths_mins):
+        """
+        Dict of bucket width (mins) -> Series, with a series for each width in
+        `bucket_widths_mins`. Each width must be a multiple of this builder's
+        width. See `rollup`.
+        """
+        return dict((width, self.rollup(width).to_series()) for width in bucket_widths_mins)
+
+    def heavy_hitters(self):
+        """
+        DataFrame of the `top_k` most frequent items in each timestep, with
+        columns
+            bucket, item, estimated_count
+        ordered by bucket, then by descending count. Estimated counts are
+        upper bounds on the true counts (see `SpaceSaving`). Timesteps with no
+        items are omitted.
+        """
+        if self._top_k is None:
+            raise ValueError("Tracking items requires top_k")
+
+        rows = []
+        for dt in sorted(self._top_items):
+            for item, count, _ in self._top_items[dt].top(self._top_k):
+                rows.append((dt, item, float(count)))
+        return pd.DataFrame(rows, columns=['bucket', 'item', 'estimated_count'])
+
+    def _count_totals(self):
+        """
+        Dict of timestep -> count, including estimated unique counts from
+        sketches.
+        """
+        totals = dict(self._counts)
+        for dt, sketch in self._sketches.iteritems():
+            totals[dt] = totals.get(dt, 0.0) + sketch.count()
+        return totals
+
     def to_series(self):
         """
+        Series of counts for every timestep between the first and last
+        timesteps with samples, with zeros for the empty timesteps. Does not
+        modify the builder.
+
         Empty Series if no samples received.
         """
-        if len(self._counts) == 0:
+        counts = self._count_totals()
+        if len(counts) == 0:
             return pd.Series()
 
-        min_dt = min(self._counts.iterkeys())
-        max_dt = max(self._counts.iterkeys())
+        min_dt = min(counts.iterkeys())
         assert min_dt.tzinfo is not None
+        freq = '%dT' % self._bucket_width_mins
 
-        td_buck = datetime.timedelta(minutes=self._bucket_width_mins)
-
-        dt_seq = []
-        counts_seq = []
-        dt = min_dt
-        while dt <= max_dt:
-            dt_seq.append(dt)
-            counts_seq.append(self._counts[dt])
-            dt += td_buck
-
-        ser = pd.Series(index=dt_seq, data=counts_seq)
+        if (60 % self._bucket_width_mins) == 0:
+            # timesteps are evenly spaced in absolute time; reindex the sparse
+            # counts (by UTC instant) onto the dense sequence of timesteps
+            sparse = pd.Series(index=pd.to_datetime(list(counts.iterkeys()), utc=True),
+                               data=list(counts.itervalues()))
+            index = pd.date_range(start=sparse.index.min(), end=sparse.index.max(),
+                                  freq=freq)
+            ser = sparse.reindex(index, fill_value=0.0)
+            ser.index = ser.index.tz_convert(min_dt.tzinfo)
+        else:
+            # timesteps are aligned to wallclock midnights, so aren't evenly
+            # spaced in absolute time across DST shifts; reindex by wallclock
+            # time instead
+            sparse = pd.Series(index=pd.DatetimeIndex([dt.replace(tzinfo=None) for dt in counts.iterkeys()]),
+                               data=list(counts.itervalues()))
+            assert sparse.index.is_unique, "Timesteps with duplicate wallclock times"
+            index = pd.date_range(start=sparse.index.min(), end=sparse.index.max(),
+                                  freq=freq)
+            ser = sparse.reindex(index, fill_value=0.0)
+            ser.index = ser.index.tz_localize(min_dt.tzinfo,
+                                              ambiguous=np.zeros(len(index), dtype=bool),
+                                              nonexistent='shift_forward')
         ser.index.name = 'snapshot'
         #ser = ser.to_period('H')  # DatetimeIndex -> PeriodIndex. Datetime is better; retains tzoffset
-        assert ser.sum() == sum(self._counts.itervalues()), [ser.sum(), sum(self._counts.itervalues())]
+        assert np.isclose(ser.sum(), sum(counts.itervalues())), [ser.sum(), sum(counts.itervalues())]
         return ser
 
 
+def _count_file(args):
+    """
+    Worker for `count_files_parallel`.
+    """
+    count_func, fpath, builder_kwargs = args
+    builder = TimeSeriesBuilder(**builder_kwargs)
+    count_func(fpath, builder)
+    return builder
+
+
+def count_files_parallel(fpaths, count_func, processes=None, **builder_kwargs):
+    """
+    Count samples from many files in parallel, using a pool of worker
+    processes, and return a single TimeSeriesBuilder of the combined counts.
+
+    Each file is counted by calling
+        count_func(fpath, builder)
+    in a worker process, where `builder` is a new TimeSeriesBuilder
+    (constructed with `builder_kwargs`) that `count_func` should increment.
+    The builders of all files are then merged.
+
+    `count_func` must be picklable; i.e., a module-level function.
+    `processes` defaults to the number of CPUs.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        builders = pool.imap_unordered(
+            _count_file,
+            [(count_func, fpath, builder_kwargs) for fpath in fpaths])
+        merged = TimeSeriesBuilder(**builder_kwargs)
+        for builder in builders:
+            merged.merge(builder)
+    finally:
+        pool.close()
+        pool.join()
+    return merged
+
+
 def main():
     from datetime import datetime
     import pytz
@@ -130,6 +882,27 @@ def main():
     vts.increment_at(datetime(2016, 1, 1,  9, 00, tzinfo=tz), "a")
     print vts.to_series()
 
+    # a DST day (clocks go forward at 2am) is a single daily timestep
+    eastern = pytz.timezone('US/Eastern')
+    before_shift = eastern.localize(datetime(2016, 3, 13, 1, 0))  # EST
+    after_shift = eastern.localize(datetime(2016, 3, 13, 5, 0))  # EDT
+
+    vts = TimeSeriesBuilder(24 * 60)
+    vts.increment_at(before_shift, "alice")
+    vts.increment_at(after_shift, "alice")
+    ser = vts.to_series()
+    print ser
+    assert len(ser) == 1 and ser.iloc[0] == 1.0
+
+    flushed = []
+    vts = TimeSeriesBuilder(24 * 60, lateness_mins=0,
+                            on_flush=lambda dt, count: flushed.append((dt, count)))
+    vts.increment_at(before_shift, "alice")
+    vts.increment_at(after_shift, "alice")
+    vts.flush_all()
+    print flushed
+    assert flushed == [(eastern.localize(datetime(2016, 3, 13)), 1.0)]
+
 
 if __name__ == "__main__":
     main()
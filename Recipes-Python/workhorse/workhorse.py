@@ -15,8 +15,15 @@ Decompose job into subjobs.
 Partitions the workload. Derives an id from anything hashable; e.g., list of
 args.
 
-Note: assumes that hashable equivalent constructed by this function is
-uniformably distriuted in the hashspace. If not, then workload is not balanced.
+Tasks are assigned to subjobs by a stable hash of their arguments (see
+`stable_hash`), so every worker process, on any machine, agrees on which
+subjob owns each task. The hash is a digest, so the workload is balanced even
+when the arguments are, e.g., small integers.
+
+To avoid every subjob generating (and hashing) the whole job, a generator can
+be partition-aware (see `WorkSpec.run` and `WorkSpec.do_block`), or the tasks
+can be enumerated once into a sharded manifest (see `write_manifest` and
+`WorkSpec.run_manifest`).
 
 
 kwarg only at the moment!
@@ -27,10 +34,22 @@ to use this id (e.g., for multiple independent databases)
 """
 
 
+import os
 import sys
+import time
 import types
+import struct
+import socket
+import sqlite3
+import hashlib
 import argparse
 import collections
+import multiprocessing
+import multiprocessing.pool
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 
 def to_hashable(args):
@@ -65,6 +84,385 @@ def to_hashable(args):
     return ret
 
 
+def _serialise(a, chunks):
+    """
+    Append a canonical byte serialisation of `a` to list `chunks`. Each
+    value is written as a type tag, the length of its payload, and the
+    payload, so that values of different types don't collide (e.g., 1 and
+    '1'). Values that are equal serialise the same (e.g., 1, 1L, 1.0, and
+    True; or 'a' and u'a'), as with `hash`.
+
+    Containers are treated as by `to_hashable`: dicts as their (key, value)
+    pairs in key order, and other unhashable iterables as tuples. Sets and
+    frozensets are ordered by the serialisations of their items, so do not
+    depend on iteration order (which varies with hash randomisation).
+    """
+    if isinstance(a, bool):
+        a = int(a)
+    elif isinstance(a, float) and a.is_integer():
+        a = int(a)
+
+    if a is None:
+        tag, payload = 'n', ''
+    elif isinstance(a, (int, long)):
+        tag, payload = 'i', str(a)
+    elif isinstance(a, float):
+        tag, payload = 'f', repr(a)
+    elif isinstance(a, unicode):
+        tag, payload = 's', a.encode('utf-8')
+    elif isinstance(a, str):
+        tag, payload = 's', a
+    elif isinstance(a, (set, frozenset)):
+        items = []
+        for item in a:
+            item_chunks = []
+            _serialise(item, item_chunks)
+            items.append(''.join(item_chunks))
+        chunks.append('z%d:' % len(items))
+        chunks.extend(sorted(items))
+        return
+    elif isinstance(a, types.DictType):
+        chunks.append('t%d:' % len(a))
+        for key in sorted(a.iterkeys()):
+            chunks.append('t2:')
+            _serialise(key, chunks)
+            _serialise(a[key], chunks)
+        return
+    elif isinstance(a, (tuple, list)):
+        chunks.append('t%d:' % len(a))
+        for item in a:
+            _serialise(item, chunks)
+        return
+    else:
+        try:
+            hash(a)
+        except TypeError:
+            try:
+                items = tuple(a)
+            except TypeError:
+                pass
+            else:
+                # other unhashable iterables
+                _serialise(items, chunks)
+                return
+        # other objects (e.g., datetimes); assumes a stable repr
+        tag, payload = 'r', '%s.%s:%r' % (type(a).__module__, type(a).__name__, a)
+    chunks.append('%s%d:' % (tag, len(payload)))
+    chunks.append(payload)
+
+
+def stable_hash(args):
+    """
+    A 64-bit hash of `args` (as for `to_hashable`) that, unlike `hash`, is
+    the same in every process and on every machine; i.e., is unaffected by
+    hash randomisation.
+
+    The hash is the first 8 bytes of the MD5 digest of a canonical byte
+    serialisation of `args` (see `_serialise`). Strings are hashed by their
+    UTF-8 encoding, so str and unicode strings that are equal have equal
+    hashes.
+    """
+    chunks = []
+    _serialise(args, chunks)
+    digest = hashlib.md5(''.join(chunks)).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+class CompletionJournal(object):
+    """
+    Append-only record of completed tasks, so that a crashed run can be
+    resumed without redoing them (see `WorkSpec.run`).
+
+    Each completed task is recorded as its `stable_hash`, one hex line per
+    task, in the file at `fpath`. Existing records are loaded on opening.
+    Records are flushed and fsynced in batches, every `sync_every` records
+    (and on `sync` and `close`), so a crash loses at most the last batch,
+    whose tasks are redone on restart. A partly written final line is
+    ignored.
+
+    Can be used as a context manager, which closes the journal on exit.
+    """
+
+    def __init__(self, fpath, sync_every=100):
+        if sync_every < 1:
+            raise ValueError("sync_every must be positive")
+        self.fpath = fpath
+        self._sync_every = sync_every
+        self._num_unsynced = 0
+        self._completed = set()
+
+        needs_newline = False
+        if os.path.exists(fpath):
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            for line in data.splitlines():
+                if len(line) == 16:
+                    try:
+                        self._completed.add(int(line, 16))
+                    except ValueError:
+                        pass
+            needs_newline = (len(data) > 0) and not data.endswith('\n')
+
+        self._file = open(fpath, 'ab')
+        if needs_newline:
+            # terminate a partly written record, so it can't corrupt the next
+            self._file.write('\n')
+
+    def __contains__(self, task_hash):
+        return task_hash in self._completed
+
+    def __len__(self):
+        return len(self._completed)
+
+    def record(self, task_hash):
+        """
+        Record the task with hash `task_hash` (see `stable_hash`) as
+        completed.
+        """
+        if task_hash in self._completed:
+            return
+        self._completed.add(task_hash)
+        self._file.write('%016x\n' % task_hash)
+        self._num_unsynced += 1
+        if self._num_unsynced >= self._sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Flush records to disk.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._num_unsynced = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_MANIFEST_FORMAT = 1
+_MANIFEST_INDEX = 'manifest.pkl'
+
+
+def _manifest_shard_path(dirpath, shard, num_shards):
+    return os.path.join(dirpath, 'shard-%05d-of-%05d.pkl' % (shard, num_shards))
+
+
+def write_manifest(taskgenfunc, dirpath, num_subjobs):
+    """
+    Enumerate the tasks (kwargs) generated by `taskgenfunc` once, into a
+    manifest in directory `dirpath` of `num_subjobs` shard files, for
+    `WorkSpec.run_manifest`. Each task is written to the shard of the
+    subjob that owns it (as for `WorkSpec.do_task`). Returns the number of
+    tasks.
+
+    Each shard is a stream of pickles: a header dict, then the kwargs of
+    each task. The index file, which records the number of shards and
+    tasks, is written last, so a manifest with an index is complete.
+    """
+    if num_subjobs < 1:
+        raise ValueError("num_subjobs must be positive")
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+    header = {'format': _MANIFEST_FORMAT, 'num_shards': num_subjobs}
+    shard_files = []
+    try:
+        for shard in range(1, num_subjobs + 1):
+            f = open(_manifest_shard_path(dirpath, shard, num_subjobs) + '.tmp', 'wb')
+            shard_files.append(f)
+            pickle.dump(dict(header, shard=shard), f, pickle.HIGHEST_PROTOCOL)
+
+        job_tasks = 0
+        for kwargs in taskgenfunc():
+            job_tasks += 1
+
+            if not isinstance(kwargs, collections.Mapping):
+                raise ValueError("Expected `kwargs` to be mappable")
+
+            shard_file = shard_files[stable_hash(kwargs) % num_subjobs]
+            pickle.dump(dict(kwargs), shard_file, pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in shard_files:
+            f.close()
+
+    for shard in range(1, num_subjobs + 1):
+        fpath = _manifest_shard_path(dirpath, shard, num_subjobs)
+        os.rename(fpath + '.tmp', fpath)
+
+    index_fpath = os.path.join(dirpath, _MANIFEST_INDEX)
+    with open(index_fpath + '.tmp', 'wb') as f:
+        pickle.dump(dict(header, job_tasks=job_tasks), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(index_fpath + '.tmp', index_fpath)
+    return job_tasks
+
+
+def _read_manifest_index(dirpath):
+    index_fpath = os.path.join(dirpath, _MANIFEST_INDEX)
+    if not os.path.exists(index_fpath):
+        raise ValueError("No complete manifest in %s" % dirpath)
+    with open(index_fpath, 'rb') as f:
+        index = pickle.load(f)
+    if index.get('format') != _MANIFEST_FORMAT:
+        raise ValueError("Unsupported manifest format: %s" % index.get('format'))
+    return index
+
+
+def _read_manifest_shard(dirpath, shard, num_shards):
+    """
+    Generate the tasks (kwargs) of one shard of a manifest.
+    """
+    with open(_manifest_shard_path(dirpath, shard, num_shards), 'rb') as f:
+        header = pickle.load(f)
+        if (header.get('format') != _MANIFEST_FORMAT) or (header.get('shard') != shard) or \
+                (header.get('num_shards') != num_shards):
+            raise ValueError("Unexpected manifest shard header: %s" % header)
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+class TaskQueue(object):
+    """
+    Shared queue of tasks in a SQLite database file at `fpath`, from which
+    any number of worker processes (on one machine, or sharing the file)
+    claim tasks dynamically (see `WorkSpec.run_dynamic`). Unlike the static
+    partitioning of `WorkSpec.do_task`, idle workers keep claiming whatever
+    work remains, so workers finish together even when task costs vary
+    widely.
+
+    A claimed task is leased to its worker for `lease_secs` seconds. If the
+    worker dies before completing the task, the lease expires and the task
+    can be claimed again; `lease_secs` should therefore exceed the longest
+    task's runtime.
+
+    Each worker process should open its own TaskQueue.
+    """
+
+    PENDING = 0
+    LEASED = 1
+    DONE = 2
+
+    def __init__(self, fpath, lease_secs=600, timeout=60):
+        self.fpath = fpath
+        self.lease_secs = lease_secs
+        self._conn = sqlite3.connect(fpath, timeout=timeout, isolation_level=None)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_hash TEXT PRIMARY KEY,
+                kwargs BLOB NOT NULL,
+                state INTEGER NOT NULL DEFAULT 0,
+                lease_expires REAL,
+                worker TEXT)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+
+    def populate(self, taskgenfunc, batch_size=1000):
+        """
+        Add the tasks (kwargs) generated by `taskgenfunc` to the queue.
+        Idempotent: tasks already in the queue (by `stable_hash`) are not
+        added again, so every worker may safely populate the queue. Returns
+        the number of tasks generated.
+        """
+        job_tasks = 0
+        rows = []
+        for kwargs in taskgenfunc():
+            job_tasks += 1
+
+            if not isinstance(kwargs, collections.Mapping):
+                raise ValueError("Expected `kwargs` to be mappable")
+
+            rows.append(('%016x' % stable_hash(kwargs),
+                         sqlite3.Binary(pickle.dumps(dict(kwargs), pickle.HIGHEST_PROTOCOL))))
+            if len(rows) == batch_size:
+                self._insert(rows)
+                rows = []
+        if rows:
+            self._insert(rows)
+        return job_tasks
+
+    def _insert(self, rows):
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks (task_hash, kwargs) VALUES (?, ?)", rows)
+
+    def claim(self, worker, num_tasks=1):
+        """
+        Lease up to `num_tasks` pending tasks (or tasks whose leases have
+        expired) to `worker` (a string identifying the worker). Returns a
+        list of (task id, kwargs) pairs; empty if no tasks are claimable.
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self._conn.execute(
+                "SELECT task_hash, kwargs FROM tasks WHERE state = ? OR "
+                "(state = ? AND lease_expires < ?) ORDER BY rowid LIMIT ?",
+                (self.PENDING, self.LEASED, now, num_tasks)).fetchall()
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, lease_expires = ?, worker = ? WHERE task_hash = ?",
+                [(self.LEASED, now + self.lease_secs, worker, task_id) for task_id, _ in rows])
+        return [(task_id, pickle.loads(str(kwargs))) for task_id, kwargs in rows]
+
+    def complete(self, task_id):
+        """
+        Mark the claimed task `task_id` as done.
+        """
+        with self._transaction():
+            self._conn.execute("UPDATE tasks SET state = ?, lease_expires = NULL WHERE task_hash = ?",
+                               (self.DONE, task_id))
+
+    def counts(self):
+        """
+        Dict of state (PENDING, LEASED, DONE) -> number of tasks.
+        """
+        counts = dict.fromkeys([self.PENDING, self.LEASED, self.DONE], 0)
+        for state, count in self._conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def _transaction(self):
+        return _SqliteTransaction(self._conn)
+
+    def close(self):
+        self._conn.close()
+
+
+class _SqliteTransaction(object):
+    """
+    Context manager for an immediate (write-locking) transaction, so that
+    concurrent workers can't claim the same task.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._conn.execute("COMMIT")
+        else:
+            self._conn.execute("ROLLBACK")
+
+
+def _exec_chunk(execfunc, chunk):
+    """
+    Execute each task (kwargs) in `chunk`; for `WorkSpec.run_parallel`.
+    """
+    for kwargs in chunk:
+        execfunc(**kwargs)
+    return len(chunk)
+
+
 class WorkSpec(object):
     
     def __init__(self, subjob_id, num_subjobs):
@@ -91,10 +489,22 @@ class WorkSpec(object):
         hashable. This function will attempt to convert dictionaries and
         lists to equivalent hashable objects.
         """
-        h = hash(to_hashable(task_kwargs))
-        return (h % self.__num_subjobs) == (self.__subjob_id - 1)
+        return self._owns(stable_hash(task_kwargs))
+
+    def _owns(self, task_hash):
+        # whether this subjob owns the task with `stable_hash` `task_hash`
+        return (task_hash % self.__num_subjobs) == (self.__subjob_id - 1)
+
+    def do_block(self, key):
+        """
+        Returns True if the block of tasks identified by `key` (anything
+        accepted by `to_hashable`) belongs to this worker. For partition-
+        aware task generators (see `run`), which can then skip generating
+        the tasks of other workers' blocks entirely.
+        """
+        return self._owns(stable_hash(key))
 
-    def run(self, taskgenfunc, execfunc):
+    def run(self, taskgenfunc, execfunc, journal=None, partition_aware=False):
         """
         Returns...
         job_tasks: Num tasks
@@ -103,22 +513,187 @@ class WorkSpec(object):
         Optional use case.
         taskgenfunc: Generate (args, kwargs) pairs.
         execfunc: Executes a task.
+        journal: A CompletionJournal. If given, each task is recorded in the
+            journal once executed, and tasks already recorded (e.g., by an
+            earlier run that crashed) are skipped. Skipped tasks are still
+            counted in subjob_tasks.
+        partition_aware: If True, `taskgenfunc` is called with this WorkSpec,
+            and must only generate this worker's tasks (e.g., using
+            `do_block` to skip whole blocks of other workers' tasks). Every
+            task generated is executed, without being hashed, and job_tasks
+            is the number of tasks generated (i.e., equals subjob_tasks).
         """
         job_tasks = 0
         subjob_tasks = 0
 
-        for kwargs in taskgenfunc():
+        if partition_aware:
+            tasks = taskgenfunc(self)
+        else:
+            tasks = taskgenfunc()
+
+        for kwargs in tasks:
             job_tasks += 1
 
             if not isinstance(kwargs, collections.Mapping):
                 raise ValueError("Expected `kwargs` to be mappable")
 
-            if self.do_task(**kwargs):
+            task_hash = None
+            if not partition_aware:
+                task_hash = stable_hash(kwargs)
+                if not self._owns(task_hash):
+                    continue
+
+            if journal is None:
                 execfunc(**kwargs)
+            else:
+                if task_hash is None:
+                    task_hash = stable_hash(kwargs)
+                if task_hash not in journal:
+                    execfunc(**kwargs)
+                    journal.record(task_hash)
+            subjob_tasks += 1
+
+        return subjob_tasks, job_tasks
+
+    def run_parallel(self, taskgenfunc, execfunc, processes=None,
+                     threads=False, chunksize=100, max_pending=None,
+                     journal=None):
+        """
+        As `run`, but executes this subjob's tasks in parallel, using a pool
+        of `processes` worker processes (default: the number of CPUs), or
+        worker threads if `threads` is True. Returns the same counts as
+        `run`.
+
+        Tasks are dispatched to workers in chunks of `chunksize`. At most
+        `max_pending` chunks (default: twice the number of workers) are
+        dispatched but not yet completed at a time; `taskgenfunc` is not
+        advanced until a chunk completes, so its tasks are not all held in
+        memory at once. If a task raises an exception, it is re-raised here.
+
+        If `journal` (a CompletionJournal) is given, tasks are recorded in it
+        as each chunk completes, and tasks already recorded are skipped, as
+        for `run`.
+
+        With processes, `execfunc` and the task arguments must be picklable;
+        e.g., `execfunc` must be a module-level function.
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize must be positive")
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 2 * processes
+
+        if threads:
+            pool = multiprocessing.pool.ThreadPool(processes)
+        else:
+            pool = multiprocessing.Pool(processes)
+
+        def complete(result, chunk_hashes):
+            result.get()
+            if journal is not None:
+                for task_hash in chunk_hashes:
+                    journal.record(task_hash)
+
+        job_tasks = 0
+        subjob_tasks = 0
+        pending = collections.deque()
+            # (async result, task hashes) of each dispatched chunk
+        try:
+            chunk = []
+            chunk_hashes = []
+            for kwargs in taskgenfunc():
+                job_tasks += 1
+
+                if not isinstance(kwargs, collections.Mapping):
+                    raise ValueError("Expected `kwargs` to be mappable")
+
+                task_hash = stable_hash(kwargs)
+                if not self._owns(task_hash):
+                    continue
                 subjob_tasks += 1
+                if (journal is not None) and (task_hash in journal):
+                    continue
+
+                chunk.append(kwargs)
+                chunk_hashes.append(task_hash)
+                if len(chunk) == chunksize:
+                    if len(pending) >= max_pending:
+                        complete(*pending.popleft())
+                    pending.append((pool.apply_async(_exec_chunk, (execfunc, chunk)), chunk_hashes))
+                    chunk = []
+                    chunk_hashes = []
+            if chunk:
+                pending.append((pool.apply_async(_exec_chunk, (execfunc, chunk)), chunk_hashes))
+
+            while pending:
+                complete(*pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
         return subjob_tasks, job_tasks
 
+    def run_manifest(self, dirpath, execfunc, journal=None):
+        """
+        As `run`, but for a job whose tasks were enumerated beforehand by
+        `write_manifest` into the manifest directory `dirpath`. Only this
+        worker's shard is read; no tasks are generated or hashed. Returns
+        the same counts as `run`.
+        """
+        index = _read_manifest_index(dirpath)
+        if index['num_shards'] != self.__num_subjobs:
+            raise ValueError("Manifest has %d shards, but there are %d subjobs" %
+                             (index['num_shards'], self.__num_subjobs))
+
+        def read_shard(workspec):
+            return _read_manifest_shard(dirpath, self.__subjob_id, self.__num_subjobs)
+
+        subjob_tasks, _ = self.run(read_shard, execfunc, journal=journal,
+                                   partition_aware=True)
+        return subjob_tasks, index['job_tasks']
+
+    def run_dynamic(self, taskgenfunc, execfunc, queue, worker=None,
+                    populate=True, poll_secs=1.0):
+        """
+        Dynamic alternative to `run`: rather than executing a fixed share of
+        the tasks, repeatedly claim and execute a task from TaskQueue `queue`
+        (shared by all workers) until every task is done.
+
+        If `populate` is True, the tasks of `taskgenfunc` are first added to
+        the queue (which is idempotent, so every worker may do so). `worker`
+        identifies this worker in the queue (default: host, process id, and
+        subjob id). When no task is claimable but other workers still hold
+        leases, this worker polls every `poll_secs` seconds, so that it
+        reclaims the tasks of any worker that dies.
+
+        Returns...
+        worker_tasks: Num tasks executed by this worker
+        job_tasks: Num tasks in the queue
+        """
+        if populate:
+            queue.populate(taskgenfunc)
+        if worker is None:
+            worker = "%s:%d:%s" % (socket.gethostname(), os.getpid(), self.__subjob_id)
+
+        worker_tasks = 0
+        while True:
+            claimed = queue.claim(worker)
+            if not claimed:
+                counts = queue.counts()
+                if counts[TaskQueue.PENDING] + counts[TaskQueue.LEASED] == 0:
+                    break
+                time.sleep(poll_secs)
+                continue
+
+            for task_id, kwargs in claimed:
+                execfunc(**kwargs)
+                queue.complete(task_id)
+                worker_tasks += 1
+
+        return worker_tasks, sum(queue.counts().itervalues())
+
     def __str__(self):
         return "<WorkSpec: %s/%s>" % (self.__subjob_id, self.__num_subjobs)
 
@@ -169,6 +744,7 @@ def test():
         print "orig = ", args
         print "\tas hashable =", as_hashable
         print "\thash        =", hash(as_hashable)
+        print "\tstable hash =", stable_hash(args)
     test_make_hashable({'key1': [1, 2, 3]})
     test_make_hashable([{'key1': [1, 2, [3]]}, {'key2': {'key3': 8}}])
     test_make_hashable({})